@@ -1,6 +1,8 @@
 import consul
-import dns.resolver
+import dns.asyncresolver
+import dns.exception
 import logging
+import time
 from consulService.config import Config
 
 logger = logging.getLogger(__name__)
@@ -13,27 +15,41 @@ consul_instance = consul.Consul(
     port=config.CONSUL_PORT
 )
 
-# DNS resolver
-consul_resolver = dns.resolver.Resolver(configure=False)
-consul_resolver.port = config.CONSUL_DNS_PORT
-consul_resolver.nameservers = [config.CONSUL_HOST]
+# Async DNS resolver
+consul_async_resolver = dns.asyncresolver.Resolver(configure=False)
+consul_async_resolver.port = config.CONSUL_DNS_PORT
+consul_async_resolver.nameservers = [config.CONSUL_HOST]
+consul_async_resolver.lifetime = config.CONSUL_DNS_TIMEOUT
 
-# Store a variable as an example
-consul_instance.kv.put("aas_example_variable", "aas_example_value")
+# Resolved replicas: service name -> (expiration time, [(address, port), ...])
+service_cache = {}
+# Next replica index of each service for round robin
+service_counters = {}
+# Smoothed response time of each replica: (address, port) -> seconds
+replica_latencies = {}
+LATENCY_SMOOTHING = 0.3
+# Replicas that failed a call: (address, port) -> time until they are not chosen
+ejected_replicas = {}
+
+
+def store_example_variable(cons=consul_instance):
+    """Store a variable as an example"""
+    cons.kv.put("aas_example_variable", "aas_example_value")
 
 
 def register_consul_service(cons=consul_instance, conf=config):
     """Register service in consul"""
     logger.debug(f"Registering {conf.SERVICE_NAME} service ({conf.SERVICE_ID})")
+    ip = conf.get_ip()
     cons.agent.service.register(
         name=conf.SERVICE_NAME,
         service_id=conf.SERVICE_ID,
-        address=conf.IP,
+        address=ip,
         port=conf.PORT,
         tags=["python", "microservice", "aas"],
         check={
             "http": 'http://{host}:{port}/{service_name}/health'.format(
-                host=conf.IP,
+                host=ip,
                 port=conf.PORT,
                 service_name=conf.SERVICE_NAME
             ),
@@ -43,39 +59,94 @@ def register_consul_service(cons=consul_instance, conf=config):
     logger.info(f"Registered {conf.SERVICE_NAME} service ({conf.SERVICE_ID})")
 
 
-def get_consul_service(service_name, consul_dns_resolver=consul_resolver):
-    """Get service from consul"""
+async def get_consul_service_async(service_name, consul_dns_resolver=consul_async_resolver):
+    """Get service from consul without blocking the event loop"""
     ret = {
         "Address": None,
         "Port": None
     }
     try:
-        #  srv_results = consul_dns_resolver.query("{}.service.consul".format(service_name), "srv")
-
-        srv_results = consul_dns_resolver.resolve(
-            "{}.service.consul".format(service_name),
-            "srv"
-        )  # SRV DNS query
-        srv_list = srv_results.response.answer  # PORT - target_name relation
-        a_list = srv_results.response.additional  # IP - target_name relation
-
-        # DNS returns a list of replicas, supposedly sorted using Round Robin. We always get the 1st element: [0]
-        srv_replica = srv_list[0][0]
-        port = srv_replica.port
-        target_name = srv_replica.target
-
-        # From all the IPs, get the one with the chosen target_name
-        for a in a_list:
-            if a.name == target_name:
-                ret['Address'] = a[0]
-                ret['Port'] = port
-                break
-
+        replicas = get_cached_replicas(service_name)
+        if replicas is None:
+            srv_results = await consul_dns_resolver.resolve(
+                "{}.service.consul".format(service_name),
+                "srv"
+            )  # SRV DNS query
+            replicas = cache_replicas(service_name, srv_results.response)
+        choose_replica(service_name, replicas, ret)
     except dns.exception.DNSException as e:
         logger.error("Could not get service url: {}".format(e))
     return ret
 
 
+def get_cached_replicas(service_name):
+    """Get the replicas of a service if the DNS answer has not expired yet"""
+    cached = service_cache.get(service_name)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+    return None
+
+
+def cache_replicas(service_name, response):
+    """Store the healthy replicas of an SRV answer for as long as its TTL allows"""
+    srv_list = response.answer  # PORT - target_name relation
+    a_list = response.additional  # IP - target_name relation
+
+    # From all the IPs, get the ones with the target_name of each replica
+    addresses = {a.name: a[0].to_text() for a in a_list if len(a) > 0}
+    replicas = []
+    for srv_rrset in srv_list:
+        for srv_replica in srv_rrset:
+            if srv_replica.target in addresses:
+                replicas.append((addresses[srv_replica.target], srv_replica.port))
+
+    ttl = max(min([rrset.ttl for rrset in srv_list], default=0), config.CONSUL_DNS_MIN_TTL)
+    service_cache[service_name] = (time.monotonic() + ttl, replicas)
+    return replicas
+
+
+def choose_replica(service_name, replicas, ret):
+    """Spread the calls across the replicas: round robin or least latency"""
+    if not replicas:
+        return
+    now = time.monotonic()
+    # Skip the replicas that failed recently, unless none is left
+    replicas = [replica for replica in replicas if ejected_replicas.get(replica, 0) <= now] or replicas
+    if config.SERVICE_BALANCING == "least_latency":
+        # Replicas without measurements go first, so all of them get measured
+        address, port = min(replicas, key=lambda replica: replica_latencies.get(replica, 0.0))
+    else:
+        index = service_counters.get(service_name, 0)
+        service_counters[service_name] = index + 1
+        address, port = replicas[index % len(replicas)]
+    ret['Address'] = address
+    ret['Port'] = port
+
+
+def report_service_latency(address, port, seconds):
+    """Record an observed response time of a replica"""
+    replica = (address, port)
+    previous = replica_latencies.get(replica)
+    if previous is None:
+        replica_latencies[replica] = seconds
+    else:
+        replica_latencies[replica] = previous + LATENCY_SMOOTHING * (seconds - previous)
+
+
+def report_service_failure(service_name, address, port):
+    """Record a failed call: eject the replica for a while and resolve the service again"""
+    replica = (address, port)
+    ejected_replicas[replica] = time.monotonic() + config.SERVICE_EJECTION_TIME
+    # Measured again from scratch once it is back
+    replica_latencies.pop(replica, None)
+    invalidate_consul_service(service_name)
+
+
+def invalidate_consul_service(service_name):
+    """Forget the cached replicas of a service, e.g. after a failed call"""
+    service_cache.pop(service_name, None)
+
+
 def get_consul_key_value_item(key, cons=consul_instance):
     """Get consul item value for the given key. It only works for string items!"""
     index, data = cons.kv.get(key)
@@ -90,6 +161,11 @@ def get_consul_service_catalog(cons=consul_instance):
     return cons.catalog.services()
 
 
+def get_consul_leader(cons=consul_instance):
+    """Raft leader of the consul cluster, an empty string if there is none"""
+    return cons.status.leader()
+
+
 def get_consul_service_replicas(cons=consul_instance):
     """Get all services including replicas"""
     return cons.agent.services()
@@ -1,8 +1,11 @@
 from os import environ
 from dotenv import load_dotenv
 import ifaddr
+import logging
 import requests
 
+logger = logging.getLogger(__name__)
+
 # Only needed for developing, on production Docker .env file is used
 load_dotenv()
 
@@ -15,6 +18,16 @@ class Config:
     PORT = int(environ.get("ORDER_PORT", '18014'))
     SERVICE_NAME = environ.get("SERVICE_NAME", "order")
     SERVICE_ID = environ.get("SERVICE_ID", "order1")
+    CONSUL_DNS_TIMEOUT = float(environ.get("CONSUL_DNS_TIMEOUT", 2))
+    # Consul answers with TTL 0 unless dns_config.service_ttl is set, keep answers at least this long
+    CONSUL_DNS_MIN_TTL = float(environ.get("CONSUL_DNS_MIN_TTL", 5))
+    # Client side load balancing: "round_robin" or "least_latency"
+    SERVICE_BALANCING = environ.get("SERVICE_BALANCING", "round_robin")
+    # A replica that fails a call is not chosen again for this long (seconds), unless all of them failed
+    SERVICE_EJECTION_TIME = float(environ.get("SERVICE_EJECTION_TIME", 15))
+    # AWS instance metadata endpoint, only reachable inside EC2
+    METADATA_URL = environ.get("METADATA_URL", "http://169.254.169.254/latest")
+    METADATA_TIMEOUT = float(environ.get("METADATA_TIMEOUT", 1))
     IP = None
 
     __instance = None
@@ -30,26 +43,34 @@ class Config:
         if Config.__instance is not None:
             raise Exception("This class is a singleton!")
         else:
-            self.get_ip()
+            # The IP is resolved on first use (get_ip), not at import time
             Config.__instance = self
 
     def get_ip(self):
-        # ip = Config.get_adapter_ip("eth0")  # this is the default interface in docker
-
-        url_token = "http://169.254.169.254/latest/api/token"
-        headers = {"X-aws-ec2-metadata-token-ttl-seconds": "21600"}
-        response = requests.put(url_token, headers=headers)
-        token = response.content.decode('utf-8')
-
-        # Usa el token para obtener la IP pública
-        url_ip = "http://169.254.169.254/latest/meta-data/local-ipv4"
-        headers = {"X-aws-ec2-metadata-token": token}
-        respuesta = requests.get(url_ip, headers=headers)
-        ip = respuesta.content.decode('utf-8')
-
-        if ip is None:
-            ip = "127.0.0.1"
-        self.IP = ip
+        """IP announced to Consul. Blocking, call it from a thread inside the event loop."""
+        if self.IP is None:
+            # ip = Config.get_adapter_ip("eth0")  # this is the default interface in docker
+            self.IP = Config.get_metadata_ip() or Config.get_adapter_ip("eth0") or "127.0.0.1"
+        return self.IP
+
+    @staticmethod
+    def get_metadata_ip():
+        try:
+            url_token = f"{Config.METADATA_URL}/api/token"
+            headers = {"X-aws-ec2-metadata-token-ttl-seconds": "21600"}
+            response = requests.put(url_token, headers=headers, timeout=Config.METADATA_TIMEOUT)
+            response.raise_for_status()
+            token = response.content.decode('utf-8')
+
+            # Usa el token para obtener la IP pública
+            url_ip = f"{Config.METADATA_URL}/meta-data/local-ipv4"
+            headers = {"X-aws-ec2-metadata-token": token}
+            respuesta = requests.get(url_ip, headers=headers, timeout=Config.METADATA_TIMEOUT)
+            respuesta.raise_for_status()
+            return respuesta.content.decode('utf-8')
+        except requests.RequestException as exc:
+            logger.warning(f"Could not get the IP from the instance metadata: {exc}")
+            return None
 
     @staticmethod
     def get_adapter_ip(nice_name):
@@ -2,9 +2,11 @@
 """FastAPI router definitions."""
 from fastapi import APIRouter, status, HTTPException
 from consulService.config import Config
-import requests
+import httpx
 import logging
-from consulService.BLConsul import get_consul_service, get_consul_service_replicas, get_consul_key_value_item, get_consul_service_catalog
+import time
+from consulService.BLConsul import get_consul_service_async, get_consul_service_replicas, get_consul_key_value_item, get_consul_service_catalog
+from consulService.BLConsul import report_service_failure, report_service_latency
     
 
 logger = logging.getLogger(__name__)
@@ -13,21 +15,22 @@ config = Config.get_instance()
 
 router = APIRouter(prefix='/{}/consul'.format(config.SERVICE_NAME))
 
+EXTERNAL_SERVICE_TIMEOUT = 10
+
 
 # Get Service from consul by name and return  ######################################################
 @router.get('/call/{external_service_name}')
 async def external_service_response(external_service_name: str):
     logger.info(f"GET external service response from {external_service_name}")
-    service = get_consul_service(external_service_name)
-    service['Name'] = external_service_name
-
-    if service is None:
+    service = await get_consul_service_async(external_service_name)
+    if service['Address'] is None:
         raise HTTPException(
             status.HTTP_404_NOT_FOUND,
             "The service does not exist or there is no healthy replica"
         )
+    service['Name'] = external_service_name
 
-    ret_message, status_code = call_external_service(service)
+    ret_message, status_code = await call_external_service(service)
 
     return {
         "message": ret_message,
@@ -67,19 +70,23 @@ async def get_services_replicas():
     return replicas
 
 
-def call_external_service(service):
+async def call_external_service(service):
     logger.debug(f"Calling external service: {service['Name']}")
     url = "http://{host}:{port}/{path}".format(
         host=service['Address'],
         port=service['Port'],
         path=service['Name']
     )
+    start = time.monotonic()
     try:
-        response = requests.get(url)
-    except requests.exceptions.ConnectionError:
+        async with httpx.AsyncClient(timeout=EXTERNAL_SERVICE_TIMEOUT) as client:
+            response = await client.get(url)
+        report_service_latency(service['Address'], service['Port'], time.monotonic() - start)
+    except httpx.TransportError:
+        report_service_failure(service['Name'], service['Address'], service['Port'])
         response = None
 
-    if response:
+    if response is not None and not response.is_error:
         ret_message = {
             "caller": config.SERVICE_NAME,
             "callerURL": "{}:{}".format(config.IP, config.PORT),
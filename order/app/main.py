@@ -2,12 +2,14 @@
 """Main file to start FastAPI application."""
 import logging
 import os
+import fcntl
 from fastapi import FastAPI
-from routers import main_router, rabbitmq, security, rabbitmq_publish_logs
-from sql import models, database
+from routers import main_router, rabbitmq, security, rabbitmq_publish_logs, outbox, health
+from sql import models, database, migrations, housekeeping
 import asyncio
 import json
-from consulService.BLConsul import register_consul_service
+import startup
+from consulService.BLConsul import config, register_consul_service, store_example_variable
 
 # Configure logging ################################################################################
 logger = logging.getLogger(__name__)
@@ -43,39 +45,124 @@ app = FastAPI(
 
 app.include_router(main_router.router)
 
+# Worker processes of the same container (gunicorn -w N) coordinate through file locks
+LOCK_DIR = os.getenv("LOCK_DIR", "/tmp")
+leader_lock_file = None
 
-@app.on_event("startup")
-async def startup_event():
+
+def open_lock_file(name):
+    return open(os.path.join(LOCK_DIR, f"order-{name}.lock"), "w")
+
+
+def acquire_leader_lock():
+    """Only one worker of the container gets it, it is released when that process exits."""
+    global leader_lock_file
+    lock_file = open_lock_file("leader")
     try:
-        """Configuration to be executed when FastAPI server starts."""
-        logger.info("Creating database tables")
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return False
+    leader_lock_file = lock_file  # Keep it open to hold the lock
+    return True
+
+
+async def create_database():
+    """Create tables and apply migrations, one worker at a time."""
+    # Shielded: if the caller is cancelled the migration goes on and keeps the lock until it ends
+    await asyncio.shield(asyncio.ensure_future(migrate_database()))
+
+
+async def migrate_database():
+    with open_lock_file("migrations") as lock_file:
+        await asyncio.to_thread(fcntl.flock, lock_file, fcntl.LOCK_EX)
         async with database.engine.begin() as conn:
             await conn.run_sync(models.Base.metadata.create_all)
-        await rabbitmq.subscribe_channel()
-        await rabbitmq_publish_logs.subscribe_channel()
-        asyncio.create_task(rabbitmq.subscribe_key_created())
-        await security.get_public_key()
-        register_consul_service()
-        asyncio.create_task(rabbitmq.subscribe_delivery_checked())
-        asyncio.create_task(rabbitmq.subscribe_payment_checked())
-        asyncio.create_task(rabbitmq.subscribe_delivery_canceled())
-        asyncio.create_task(rabbitmq.subscribe_pieces())
-        asyncio.create_task(rabbitmq.subscribe_delivering())
-        asyncio.create_task(rabbitmq.subscribe_delivered())
-        data = {
-            "message": "INFO - Servicio Order inicializado correctamente"
-        }
-        message_body = json.dumps(data)
-        routing_key = "order.main_startup_event.info"
-        await rabbitmq_publish_logs.publish_log(message_body, routing_key)
-
-    except:
-        data = {
-            "message": "ERROR - Error al inicializar el servicio Order"
-        }
-        message_body = json.dumps(data)
-        routing_key = "order.main_startup_event.error"
-        await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+            await conn.run_sync(migrations.run_migrations)
+
+
+async def register_service():
+    """Resolve the service IP and, on the container leader, register it in Consul."""
+    await asyncio.to_thread(config.get_ip)
+    if leader_lock_file is not None:
+        await asyncio.to_thread(register_consul_service)
+        await asyncio.to_thread(store_example_variable)
+
+
+async def load_public_key():
+    """Fetch the public key of the client service, retried by the startup step while it fails."""
+    if not await security.get_public_key():
+        raise RuntimeError("Public key not available")
+
+
+async def publish_startup_log(message, routing_key):
+    data = {
+        "message": message
+    }
+    message_body = json.dumps(data)
+    await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+
+
+async def start_service():
+    """Critical steps run concurrently and are retried until they succeed, then consumers start."""
+    await asyncio.gather(
+        # No timeout: a migration of a large database may take long, and cancelling it would not stop it
+        startup.run_until_done("database", create_database, timeout=None),
+        startup.run_until_done("broker", rabbitmq.subscribe_channel)
+    )
+    # Per container tasks: outbox relay and housekeeping
+    if leader_lock_file is not None:
+        startup.start_task(outbox.relay_outbox())
+        startup.start_task(housekeeping.purge_expired_records())
+    for subscribe in (
+            rabbitmq.subscribe_key_created,
+            rabbitmq.subscribe_delivery_checked,
+            rabbitmq.subscribe_payment_checked,
+            rabbitmq.subscribe_delivery_canceled,
+            rabbitmq.subscribe_pieces,
+            rabbitmq.subscribe_delivering,
+            rabbitmq.subscribe_delivered):
+        startup.start_task(subscribe())
+    startup.set_ready()
+    await publish_startup_log(
+        "INFO - Servicio Order inicializado correctamente",
+        "order.main_startup_event.info"
+    )
+
+
+async def report_slow_startup(service_task):
+    """Log an error if the service is not ready after one step timeout, startup goes on."""
+    await asyncio.wait({service_task}, timeout=startup.STARTUP_STEP_TIMEOUT)
+    if not startup.is_ready():
+        logger.error("Service not ready yet, startup continues in background")
+        await publish_startup_log(
+            "ERROR - Error al inicializar el servicio Order",
+            "order.main_startup_event.error"
+        )
+
+
+@app.on_event("startup")
+async def startup_event():
+    """Configuration to be executed when FastAPI server starts."""
+    startup.begin()
+    # Keeps the dependency snapshot used by /order/health, /order/livez and /order/readyz
+    startup.start_task(health.monitor_dependencies())
+    if acquire_leader_lock():
+        logger.info(f"Worker {os.getpid()} is the container leader")
+    # Non critical steps: log shipping (messages are queued meanwhile), public key and Consul
+    startup.defer("logs", rabbitmq_publish_logs.subscribe_channel)
+    startup.defer("public_key", load_public_key)
+    startup.defer("consul", register_service)
+    # Return right away: gunicorn only gets heartbeats from the worker once startup has finished,
+    # so the service starts in background and /order/readyz reports its progress
+    service_task = startup.start_task(start_service())
+    startup.start_task(report_slow_startup(service_task))
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Configuration to be executed when FastAPI server stops."""
+    await security.close_http_client()
 
 
 # Main #############################################################################################
@@ -0,0 +1,187 @@
+import aio_pika
+import asyncio
+import logging
+import time
+import uuid
+from aio_pika.exceptions import DeliveryError
+from os import environ
+
+logger = logging.getLogger(__name__)
+
+# Connection manager configuration
+PUBLISHER_CHANNELS = int(environ.get("PUBLISHER_CHANNELS", 4))
+# Unconfirmed publishes per channel above which the broker is reported as saturated
+PUBLISH_HIGH_WATERMARK = int(environ.get("PUBLISH_HIGH_WATERMARK", 100))
+# Publisher confirms: unconfirmed messages allowed at once, and retries of nacked or timed out messages
+PUBLISH_WINDOW = int(environ.get("PUBLISH_WINDOW", 256))
+PUBLISH_TIMEOUT = float(environ.get("PUBLISH_TIMEOUT", 10))
+PUBLISH_RETRIES = int(environ.get("PUBLISH_RETRIES", 3))
+PUBLISH_RETRY_DELAY = float(environ.get("PUBLISH_RETRY_DELAY", 0.5))
+
+connection = None
+connection_lock = asyncio.Lock()
+# Confirming channels used to publish, with the exchanges declared on each of them
+publisher_channels = []
+publisher_exchanges = []
+publisher_in_flight = []
+consumer_channels = []
+publish_window = asyncio.Semaphore(PUBLISH_WINDOW)
+broker_stats = {
+    "reconnections": 0
+}
+publish_stats = {
+    "confirmed": 0,
+    "nacked": 0,
+    "timeouts": 0,
+    "retried": 0,
+    "failed": 0,
+    "in_flight": 0,
+    "in_flight_max": 0,
+    "latency_total": 0.0,
+    "latency_max": 0.0
+}
+
+
+async def connect():
+    # Single connection per process, shared by every consumer and publisher
+    global connection
+    async with connection_lock:
+        if connection is None:
+            new_connection = await aio_pika.connect_robust(
+                host=environ.get("RABBITMQ_IP"),
+                port=5672,
+                virtualhost='/',
+                login='user',
+                password='user'
+            )
+            new_connection.reconnect_callbacks.add(on_reconnect)
+            # Open every channel before publishing them, a cancelled attempt leaves no half pool
+            channels = [await new_connection.channel(publisher_confirms=True) for _ in range(PUBLISHER_CHANNELS)]
+            publisher_channels.extend(channels)
+            publisher_exchanges.extend({} for _ in channels)
+            publisher_in_flight.extend(0 for _ in channels)
+            connection = new_connection
+    return connection
+
+
+def on_reconnect(*args, **kwargs):
+    broker_stats["reconnections"] += 1
+    logger.warning("Reconnected to RabbitMQ")
+
+
+async def open_channel(prefetch_count=None, publisher_confirms=False):
+    # Dedicated channel, e.g. one per consumer so its acks do not wait behind other traffic
+    channel = await (await connect()).channel(publisher_confirms=publisher_confirms)
+    if prefetch_count is not None:
+        await channel.set_qos(prefetch_count=prefetch_count)
+    return channel
+
+
+async def consumer_channel(prefetch_count):
+    channel = await open_channel(prefetch_count=prefetch_count)
+    consumer_channels.append(channel)
+    return channel
+
+
+async def declare_exchange(channel, exchange_name):
+    return await channel.declare_exchange(name=exchange_name, type='topic', durable=True)
+
+
+async def get_publisher(exchange_name):
+    # Least busy publisher channel, so a burst on one channel does not delay the others
+    await connect()
+    index = min(range(len(publisher_channels)), key=lambda i: publisher_in_flight[i])
+    exchanges = publisher_exchanges[index]
+    if exchange_name not in exchanges:
+        exchanges[exchange_name] = await declare_exchange(publisher_channels[index], exchange_name)
+    return index, exchanges[exchange_name]
+
+
+async def publish(exchange_name, message_body, routing_key, message_id=None):
+    # Publish the message to the exchange, waits for the broker confirmation.
+    # Up to PUBLISH_WINDOW messages wait for their confirmation at the same time, the broker
+    # acknowledges them together (multiple ack) instead of one round trip per message
+    # Every copy of a retried message keeps the same id, so consumers can drop duplicates
+    message = aio_pika.Message(
+        body=message_body.encode(),
+        content_type="text/plain",
+        delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+        message_id=message_id or str(uuid.uuid4())
+    )
+    async with publish_window:
+        publish_stats["in_flight"] += 1
+        publish_stats["in_flight_max"] = max(publish_stats["in_flight_max"], publish_stats["in_flight"])
+        try:
+            for attempt in range(PUBLISH_RETRIES + 1):
+                try:
+                    await publish_confirmed(exchange_name, message, routing_key)
+                    return
+                except (DeliveryError, asyncio.TimeoutError) as exc:
+                    # Nacked or not confirmed in time: publish it again. A timed out message may have
+                    # reached the broker, the copy carries the same message_id
+                    if isinstance(exc, asyncio.TimeoutError):
+                        publish_stats["timeouts"] += 1
+                    else:
+                        publish_stats["nacked"] += 1
+                    if attempt == PUBLISH_RETRIES:
+                        publish_stats["failed"] += 1
+                        raise
+                    publish_stats["retried"] += 1
+                    logger.warning(f"Retrying {routing_key} message: {exc!r}")
+                    await asyncio.sleep(PUBLISH_RETRY_DELAY * (attempt + 1))
+        finally:
+            publish_stats["in_flight"] -= 1
+
+
+async def publish_confirmed(exchange_name, message, routing_key):
+    index, exchange = await get_publisher(exchange_name)
+    publisher_in_flight[index] += 1
+    start = time.monotonic()
+    try:
+        await exchange.publish(message, routing_key=routing_key, timeout=PUBLISH_TIMEOUT)
+    finally:
+        publisher_in_flight[index] -= 1
+    latency = time.monotonic() - start
+    publish_stats["confirmed"] += 1
+    publish_stats["latency_total"] += latency
+    publish_stats["latency_max"] = max(publish_stats["latency_max"], latency)
+
+
+def is_blocked():
+    # RabbitMQ flow control: the broker sends connection.blocked on a memory or disk alarm and stops
+    # reading from publishing connections until connection.unblocked. aio-pika 9 has no callbacks
+    # for them, aiormq handles both frames and keeps the state in its "unblocked" event
+    if connection is None or connection.transport is None:
+        return False
+    unblocked = getattr(connection.transport.connection, "_Connection__connection_unblocked", None)
+    return unblocked is not None and not unblocked.is_set()
+
+
+def is_saturated():
+    # Blocked by the broker, or every publisher channel above the watermark: the broker is not
+    # keeping up with confirms
+    if is_blocked():
+        return True
+    return bool(publisher_in_flight) and min(publisher_in_flight) >= PUBLISH_HIGH_WATERMARK
+
+
+def get_broker_stats():
+    # Back-pressure signals: flow control of the broker and publishes waiting for confirmation per channel
+    return dict(
+        broker_stats,
+        connected=connection is not None and not connection.is_closed,
+        blocked=is_blocked(),
+        consumer_channels=len(consumer_channels),
+        publisher_in_flight=list(publisher_in_flight),
+        saturated=is_saturated()
+    )
+
+
+def get_publish_stats():
+    # Publish latency (until the broker confirmation) and occupancy of the confirm window
+    confirmed = publish_stats["confirmed"]
+    return dict(
+        publish_stats,
+        window=PUBLISH_WINDOW,
+        latency_avg=publish_stats["latency_total"] / confirmed if confirmed else 0.0
+    )
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""Background monitor of the dependencies, probes answer from its last snapshot."""
+import asyncio
+import logging
+import time
+from os import environ
+from sql.database import SessionLocal
+from sql import crud
+from routers import broker
+from routers import security
+from consulService.BLConsul import get_consul_leader
+import startup
+
+logger = logging.getLogger(__name__)
+
+HEALTH_CHECK_INTERVAL = float(environ.get("HEALTH_CHECK_INTERVAL", 5))
+HEALTH_CHECK_TIMEOUT = float(environ.get("HEALTH_CHECK_TIMEOUT", 2))
+# The service is not ready without these, Consul is only reported
+REQUIRED_DEPENDENCIES = ("database", "broker", "public_key")
+
+# Dependency name -> {"ok", "checked_at", "seconds", "error"}, replaced on every check
+dependency_state = {}
+last_check = None
+consul_check_task = None
+
+
+async def check_database():
+    db = SessionLocal()
+    try:
+        await crud.check_database(db)
+    finally:
+        await db.close()
+
+
+async def check_broker():
+    if not broker.get_broker_stats()["connected"]:
+        raise RuntimeError("Not connected to RabbitMQ")
+    # A blocked connection (RabbitMQ flow control) is reported, publishes wait until it is unblocked
+    return {"blocked": broker.is_blocked()}
+
+
+async def check_public_key():
+    if not await security.isTherePublicKey():
+        raise RuntimeError("Public key not available")
+
+
+async def check_consul():
+    # Blocking client in a thread: a hung call is shielded and reused, threads do not pile up
+    global consul_check_task
+    if consul_check_task is None or consul_check_task.done():
+        consul_check_task = asyncio.ensure_future(asyncio.to_thread(get_consul_leader))
+    if not await asyncio.shield(consul_check_task):
+        raise RuntimeError("Consul has no leader")
+
+
+DEPENDENCY_CHECKS = {
+    "database": check_database,
+    "broker": check_broker,
+    "public_key": check_public_key,
+    "consul": check_consul
+}
+
+
+async def check_dependency(check):
+    start = time.monotonic()
+    try:
+        # A check may return details of the dependency to report with its state
+        state = {"ok": True, **(await asyncio.wait_for(check(), HEALTH_CHECK_TIMEOUT) or {})}
+    except asyncio.TimeoutError:
+        state = {"ok": False, "error": f"Timed out after {HEALTH_CHECK_TIMEOUT}s"}
+    except Exception as exc:  # @ToDo: To broad exception
+        state = {"ok": False, "error": repr(exc)}
+    state["seconds"] = round(time.monotonic() - start, 3)
+    state["checked_at"] = time.time()
+    return state
+
+
+async def check_dependencies():
+    """Check every dependency concurrently and publish the new snapshot at once."""
+    global dependency_state, last_check
+    names = list(DEPENDENCY_CHECKS)
+    states = await asyncio.gather(*[check_dependency(DEPENDENCY_CHECKS[name]) for name in names])
+    for name, state in zip(names, states):
+        previous = dependency_state.get(name)
+        if previous is not None and previous["ok"] != state["ok"]:
+            logger.warning(f"Dependency {name} is now {'up' if state['ok'] else 'down'}")
+    dependency_state = dict(zip(names, states))
+    last_check = time.monotonic()
+
+
+async def monitor_dependencies():
+    while True:
+        try:
+            await check_dependencies()
+        except Exception as exc:  # @ToDo: To broad exception
+            logger.error(f"Error checking the dependencies: {exc}")
+        await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+
+
+def is_alive():
+    # The monitor keeps running unless the event loop is stalled
+    return last_check is None or time.monotonic() - last_check < 3 * (HEALTH_CHECK_INTERVAL + HEALTH_CHECK_TIMEOUT)
+
+
+def is_ready():
+    # Startup finished (consumers running) and the required dependencies were up in the last check
+    return startup.is_ready() and all(
+        dependency_state.get(name, {}).get("ok", False) for name in REQUIRED_DEPENDENCIES
+    )
+
+
+def get_dependency_state():
+    return {name: dict(state) for name, state in dependency_state.items()}
@@ -1,19 +1,47 @@
 # -*- coding: utf-8 -*-
 """FastAPI router definitions."""
+import hashlib
 import logging
+import os
+import zlib
+from datetime import datetime
 from typing import List
-from fastapi import APIRouter, Depends, status, Header, Query
+from fastapi import APIRouter, Depends, HTTPException, status, Header, Query, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 from dependencies import get_db
-from sql import crud, schemas
+from sql import crud, schemas, order_cache
+from sql.database import SessionLocal
 from routers import security
-from routers.router_utils import raise_and_log_error
+from routers.router_utils import raise_and_log_error, encode_cursor, decode_cursor
 from routers import rabbitmq_publish_logs
+from routers import outbox
+from routers import message_dedup
+from routers import broker
+from routers import health
+import startup
 import json
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
+# Order list pagination
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Responses of POST /order with an Idempotency-Key header are replayed for this long (seconds)
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", 24 * 3600))
+
+# Maximum number of orders retrieved by a batch lookup
+MAX_BATCH_IDS = 500
+
+# Maximum number of orders created by a bulk creation
+MAX_BULK_ORDERS = 500
+
+# Rows read from the database and sent in each chunk of an export
+EXPORT_CHUNK_SIZE = 1000
+
 
 @router.get(
     "/order/health",
@@ -23,12 +51,80 @@ router = APIRouter()
 async def health_check():
     """Endpoint to check if everything started correctly."""
     logger.debug("GET '/order/health' endpoint called.")
-    if await security.isTherePublicKey():
+    # Answered from the last dependency check, probes never call the dependencies
+    if health.is_ready():
         return {"detail": "Service Healthy."}
     else:
         raise_and_log_error(logger, status.HTTP_503_SERVICE_UNAVAILABLE, "Service Unavailable.")
 
 
+@router.get(
+    "/order/livez",
+    summary="Liveness probe",
+    response_model=schemas.Message,
+)
+async def liveness_check():
+    """Endpoint to check that the process is running and its event loop is not stalled."""
+    if health.is_alive():
+        return {"detail": "Service Alive."}
+    else:
+        raise_and_log_error(logger, status.HTTP_503_SERVICE_UNAVAILABLE, "Service Stalled.")
+
+
+@router.get(
+    "/order/readyz",
+    summary="Readiness probe",
+)
+async def readiness_check(response: Response):
+    """Endpoint to check if the service can handle requests, with the state of its dependencies."""
+    ready = health.is_ready()
+    if not ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return {
+        "ready": ready,
+        "startup": startup.get_startup_state()["status"],
+        "dependencies": health.get_dependency_state()
+    }
+
+
+@router.get(
+    "/order/metrics",
+    summary="Internal counters of the service",
+)
+async def get_metrics():
+    """Endpoint to expose the internal counters of the service."""
+    logger.debug("GET '/order/metrics' endpoint called.")
+    return {
+        "startup": startup.get_startup_state(),
+        "logs": rabbitmq_publish_logs.get_log_stats(),
+        "token_cache": security.get_token_cache_stats(),
+        "outbox": outbox.get_outbox_stats(),
+        "order_cache": order_cache.get_stats(),
+        "message_dedup": message_dedup.get_dedup_stats(),
+        "broker": broker.get_broker_stats(),
+        "publisher": broker.get_publish_stats()
+    }
+
+
+async def replay_idempotent_response(record, request_hash):
+    """Response stored for an idempotency key, rejected if the key was used for another request."""
+    if record.request_hash is not None and record.request_hash != request_hash:
+        raise_and_log_error(logger, status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            "Idempotency-Key already used with a different request")
+    data = {
+        "message": "INFO - Order creation replayed"
+    }
+    message_body = json.dumps(data)
+    routing_key = "order.main_router_create_order.info"
+    await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+    return Response(
+        content=record.response_body,
+        status_code=record.status_code,
+        media_type="application/json",
+        headers={"Idempotent-Replayed": "true"}
+    )
+
+
 @router.post(
     "/order",
     response_model=schemas.Order,
@@ -39,7 +135,8 @@ async def health_check():
 async def create_order(
         order_schema: schemas.OrderPost,
         db: AsyncSession = Depends(get_db),
-        token: str = Header(..., description="JWT Token in the Header")
+        token: str = Header(..., description="JWT Token in the Header"),
+        idempotency_key: str = Header(None, description="Retries with the same key replay the first response")
 ):
     """Create single order endpoint."""
     logger.debug("POST '/order' endpoint called.")
@@ -58,7 +155,23 @@ async def create_order(
             raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"The token is expired, please log in again")
         else:
             order_schema.id_client = payload["id_client"]
-            db_order = await crud.create_order(db, order_schema)
+            record_key = None
+            request_hash = None
+            if idempotency_key is not None:
+                # Keys are scoped to the client
+                record_key = f"{payload['id_client']}:{idempotency_key}"
+                request_hash = hashlib.sha256(order_schema.json(sort_keys=True).encode()).hexdigest()
+                record = await crud.get_idempotency_record(db, record_key)
+                if record is not None:
+                    return await replay_idempotent_response(record, request_hash)
+            try:
+                db_order = await crud.create_order(db, order_schema, record_key, IDEMPOTENCY_TTL, request_hash)
+            except IntegrityError:
+                # A concurrent request with the same key committed first: replay its response
+                record = await crud.get_idempotency_record(db, record_key) if record_key is not None else None
+                if record is None:
+                    raise
+                return await replay_idempotent_response(record, request_hash)
             data = {
                 "message": "INFO - Order created"
             }
@@ -66,6 +179,8 @@ async def create_order(
             routing_key = "order.main_router_create_order.info"
             await rabbitmq_publish_logs.publish_log(message_body, routing_key)
             return db_order
+    except HTTPException:
+        raise
     except Exception as exc:  # @ToDo: To broad exception
         data = {
             "message": "ERROR - Error creating the order"
@@ -77,6 +192,62 @@ async def create_order(
 
 
 
+@router.post(
+    "/order/bulk",
+    response_model=List[schemas.OrderBulkResult],
+    summary="Create several orders",
+    status_code=status.HTTP_201_CREATED,
+    tags=["Order"]
+)
+async def create_orders_bulk(
+        bulk_schema: schemas.OrderBulkPost,
+        db: AsyncSession = Depends(get_db),
+        token: str = Header(..., description="JWT Token in the Header")
+):
+    """Create several orders in a single transaction, with a result per order."""
+    logger.debug("POST '/order/bulk' endpoint called.")
+    if len(bulk_schema.orders) > MAX_BULK_ORDERS:
+        raise_and_log_error(logger, status.HTTP_400_BAD_REQUEST, f"At most {MAX_BULK_ORDERS} orders per request")
+    #decodificar el token
+    payload = security.decode_token(token)
+    # validar fecha expiración del token
+    is_expirated = security.validar_fecha_expiracion(payload)
+    if(is_expirated):
+        data = {
+            "message": "ERROR - Token expired, log in again"
+        }
+        message_body = json.dumps(data)
+        routing_key = "order.main_router_create_orders_bulk.error"
+        await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+        raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"The token is expired, please log in again")
+    for order_schema in bulk_schema.orders:
+        order_schema.id_client = payload["id_client"]
+    try:
+        results = await crud.create_orders_bulk(db, bulk_schema.orders)
+    except Exception as exc:  # @ToDo: To broad exception
+        data = {
+            "message": "ERROR - Error creating the orders"
+        }
+        message_body = json.dumps(data)
+        routing_key = "order.main_router_create_orders_bulk.error"
+        await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+        raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"Error creating orders: {exc}")
+    data = {
+        "message": f"INFO - {sum(1 for db_order, error in results if db_order is not None)} orders created"
+    }
+    message_body = json.dumps(data)
+    routing_key = "order.main_router_create_orders_bulk.info"
+    await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+    return [
+        schemas.OrderBulkResult(
+            index=index,
+            order=schemas.Order.from_orm(db_order) if db_order is not None else None,
+            detail=error
+        )
+        for index, (db_order, error) in enumerate(results)
+    ]
+
+
 @router.get(
     "/order",
     summary="Retrieve single order by id",
@@ -92,13 +263,32 @@ async def create_order(
     tags=['Order']
 )
 async def get_single_order(
+        response: Response,
         order_id: int = Query(None, description="Order ID"),
         client_id: int = Query(None, description="Client ID"),
+        limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Orders per page (order lists)"),
+        cursor: str = Query(None, description="X-Next-Cursor header of the previous page (order lists)"),
+        status_order: str = Query(None, description="Only orders in this status (order lists)"),
+        date_from: datetime = Query(None, description="Only orders created from this date (order lists)"),
+        date_to: datetime = Query(None, description="Only orders created before this date (order lists)"),
+        include: str = Query(None, regex="^pieces$", description="'pieces' to include the pieces of the orders"),
         db: AsyncSession = Depends(get_db),
         token: str = Header(..., description="JWT Token in the Header")
 ):
-    """Retrieve single order by id"""
+    """Retrieve single order by id, or a page of orders.
+
+    Order lists are paginated by id: the X-Next-Cursor response header is sent
+    while there are more orders, pass it as cursor to get the next page.
+    """
     logger.debug("GET '/order' endpoint called.", order_id)
+    after_id = None
+    if cursor is not None:
+        try:
+            after_id = decode_cursor(cursor)
+        except ValueError:
+            raise_and_log_error(logger, status.HTTP_400_BAD_REQUEST, f"Invalid cursor: {cursor}")
+    include_pieces = include == "pieces"
+    order_schema = schemas.OrderWithPieces if include_pieces else schemas.Order
 
     if order_id is None and client_id is None:
         try:
@@ -117,14 +307,18 @@ async def get_single_order(
             else:
                 es_admin = security.validar_es_admin(payload)
                 if(es_admin):
-                    order_list = await crud.get_orders_list(db)
+                    order_list, has_more = await crud.get_orders_list(
+                        db, limit, after_id, status_order, date_from, date_to, include_pieces
+                    )
+                    if has_more:
+                        response.headers["X-Next-Cursor"] = encode_cursor(order_list[-1].id_order)
                     data = {
                         "message": "INFO - Order list obtained"
                     }
                     message_body = json.dumps(data)
                     routing_key = "order.main_router_get_order_list.info"
                     await rabbitmq_publish_logs.publish_log(message_body, routing_key)
-                    return order_list
+                    return [order_schema.from_orm(order) for order in order_list]
                 else:
                     data = {
                         "message": "ERROR - You don't have permissions"
@@ -160,8 +354,8 @@ async def get_single_order(
             else:
                 es_admin = security.validar_es_admin(payload)
                 client_id = payload["id_client"]
-                order = await crud.get_order(db, order_id)
-                if(es_admin==False and order.id_client!=client_id):
+                order = await get_order_response(db, order_id, order_schema)
+                if(es_admin==False and order["id_client"]!=client_id):
                     data = {
                         "message": "ERROR - You don't have permissions"
                     }
@@ -216,8 +410,12 @@ async def get_single_order(
                 routing_key = "order.main_router_get_single_client.error"
                 await rabbitmq_publish_logs.publish_log(message_body, routing_key)
                 raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"You don't have permissions")
-        orders = await crud.get_clients_orders(db, client_id)
-        if not orders:
+        orders, has_more = await crud.get_clients_orders(
+            db, client_id, limit, after_id, status_order, date_from, date_to, include_pieces
+        )
+        if has_more:
+            response.headers["X-Next-Cursor"] = encode_cursor(orders[-1].id_order)
+        if not orders and cursor is None:
             data = {
                 "message": "ERROR - Clinet {client_id}'s orders not found"
             }
@@ -231,7 +429,116 @@ async def get_single_order(
         message_body = json.dumps(data)
         routing_key = "order.main_router_get_single_client.info"
         await rabbitmq_publish_logs.publish_log(message_body, routing_key)
-        return orders
+        return [order_schema.from_orm(order) for order in orders]
+
+async def get_order_response(db: AsyncSession, order_id: int, order_schema):
+    """Serialized order, read through the order cache. None if it does not exist."""
+    include_pieces = order_schema is schemas.OrderWithPieces
+    order = order_cache.get(order_id, include_pieces)
+    if order is None:
+        db_order = await crud.get_order(db, order_id, include_pieces)
+        if db_order is None:
+            return None
+        order = order_schema.from_orm(db_order).dict()
+        order_cache.put(order_id, include_pieces, order)
+    return order
+
+@router.get(
+    "/order/batch",
+    summary="Retrieve several orders by id",
+    responses={
+        status.HTTP_200_OK: {
+            "description": "Requested orders by id, null if not found or not allowed."
+        }
+    },
+    tags=['Order']
+)
+async def get_orders_batch(
+        ids: str = Query(..., description="Comma separated order IDs", example="1,2,3"),
+        include: str = Query(None, regex="^pieces$", description="'pieces' to include the pieces of the orders"),
+        db: AsyncSession = Depends(get_db),
+        token: str = Header(..., description="JWT Token in the Header")
+):
+    """Retrieve several orders by id"""
+    logger.debug("GET '/order/batch' endpoint called.")
+    try:
+        order_ids = [int(order_id) for order_id in ids.split(",") if order_id.strip()]
+    except ValueError:
+        raise_and_log_error(logger, status.HTTP_400_BAD_REQUEST, f"Invalid order ids: {ids}")
+    return await get_orders_by_ids(db, order_ids, include, token)
+
+
+@router.post(
+    "/order/batch",
+    summary="Retrieve several orders by id",
+    responses={
+        status.HTTP_200_OK: {
+            "description": "Requested orders by id, null if not found or not allowed."
+        }
+    },
+    tags=['Order']
+)
+async def post_orders_batch(
+        batch_schema: schemas.OrderBatchPost,
+        db: AsyncSession = Depends(get_db),
+        token: str = Header(..., description="JWT Token in the Header")
+):
+    """Retrieve several orders by id (ids in the body)"""
+    logger.debug("POST '/order/batch' endpoint called.")
+    if batch_schema.include not in (None, "pieces"):
+        raise_and_log_error(logger, status.HTTP_400_BAD_REQUEST, f"Invalid include: {batch_schema.include}")
+    return await get_orders_by_ids(db, batch_schema.ids, batch_schema.include, token)
+
+
+async def get_orders_by_ids(db: AsyncSession, order_ids: List[int], include: str, token: str):
+    """Authorize once, then resolve all the orders from the cache and a single IN query."""
+    if len(order_ids) > MAX_BATCH_IDS:
+        raise_and_log_error(logger, status.HTTP_400_BAD_REQUEST, f"At most {MAX_BATCH_IDS} orders per batch")
+    payload = security.decode_token(token)
+    # validar fecha expiración del token
+    is_expirated = security.validar_fecha_expiracion(payload)
+    if(is_expirated):
+        data = {
+            "message": "ERROR - Token expired, log in again"
+        }
+        message_body = json.dumps(data)
+        routing_key = "order.main_router_get_orders_batch.error"
+        await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+        raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"The token is expired, please log in again")
+    es_admin = security.validar_es_admin(payload)
+    client_id = payload["id_client"]
+    include_pieces = include == "pieces"
+    order_schema = schemas.OrderWithPieces if include_pieces else schemas.Order
+
+    orders = {}
+    missing_ids = []
+    for order_id in order_ids:
+        order = order_cache.get(order_id, include_pieces)
+        if order is None:
+            missing_ids.append(order_id)
+        else:
+            orders[order_id] = order
+    if missing_ids:
+        for db_order in await crud.get_orders_by_ids(db, missing_ids, include_pieces):
+            order = order_schema.from_orm(db_order).dict()
+            order_cache.put(db_order.id_order, include_pieces, order)
+            orders[db_order.id_order] = order
+
+    # Orders of other clients are answered as not found
+    response = {}
+    for order_id in order_ids:
+        order = orders.get(order_id)
+        if order is not None and (es_admin or order["id_client"] == client_id):
+            response[order_id] = order
+        else:
+            response[order_id] = None
+    data = {
+        "message": "INFO - Orders obtained"
+    }
+    message_body = json.dumps(data)
+    routing_key = "order.main_router_get_orders_batch.info"
+    await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+    return response
 
 ## Cambiar endpoint
 # @router.get(
@@ -353,3 +660,79 @@ async def get_sagas_history(
     routing_key = "order.main_router_get_sagas_history.info"
     await rabbitmq_publish_logs.publish_log(message_body, routing_key)
     return logs
+
+
+@router.get(
+    "/order/export",
+    summary="Export a whole table as NDJSON",
+    responses={
+        status.HTTP_200_OK: {
+            "content": {"application/x-ndjson": {}},
+            "description": "One JSON object per line and row."
+        }
+    },
+    tags=['Order']
+)
+async def export_table(
+        table: str = Query(..., regex="^(orders|pieces|sagas)$", description="Table to export"),
+        compress: bool = Query(False, description="Gzip compress the response"),
+        token: str = Header(..., description="JWT Token in the Header")
+):
+    """Stream a whole table, one JSON object per line, with constant memory."""
+    logger.debug("GET '/order/export' endpoint called.")
+    payload = security.decode_token(token)
+    # validar fecha expiración del token
+    is_expirated = security.validar_fecha_expiracion(payload)
+    if(is_expirated):
+        data = {
+            "message": "ERROR - Token expired, log in again"
+        }
+        message_body = json.dumps(data)
+        routing_key = "order.main_router_export_table.error"
+        await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+        raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"The token is expired, please log in again")
+    else:
+        es_admin = security.validar_es_admin(payload)
+        if(es_admin==False):
+            data = {
+                "message": "ERROR - You don't have permissions"
+            }
+            message_body = json.dumps(data)
+            routing_key = "order.main_router_export_table.error"
+            await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+            raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"You don't have permissions")
+    data = {
+        "message": f"INFO - Exporting {table}"
+    }
+    message_body = json.dumps(data)
+    routing_key = "order.main_router_export_table.info"
+    await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+    headers = {"Content-Encoding": "gzip"} if compress else None
+    return StreamingResponse(
+        generate_export(crud.EXPORT_TABLES[table], compress),
+        media_type="application/x-ndjson",
+        headers=headers
+    )
+
+
+async def generate_export(model, compress):
+    # The response outlives the request dependencies, it uses its own session
+    db = SessionLocal()
+    compressor = zlib.compressobj(wbits=31) if compress else None  # wbits=31: gzip format
+    try:
+        async for rows in crud.stream_table_rows(db, model, EXPORT_CHUNK_SIZE):
+            chunk = "".join(json.dumps(row, default=export_json_default) + "\n" for row in rows).encode()
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+        if compressor is not None:
+            yield compressor.flush()
+    finally:
+        await db.close()
+
+
+def export_json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
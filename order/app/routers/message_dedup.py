@@ -0,0 +1,43 @@
+from collections import OrderedDict
+from os import environ
+
+# Keys of the last handled saga messages, checked before going to the database
+DEDUP_CACHE_SIZE = int(environ.get("DEDUP_CACHE_SIZE", 100000))
+
+handled_messages = OrderedDict()
+dedup_stats = {
+    "duplicates": 0
+}
+
+
+def get_message_key(message, data):
+    # Publishers may not set a message id: identify the message by order and transition
+    if message.message_id:
+        return message.message_id
+    return "{}:{}:{}".format(
+        message.routing_key,
+        data.get("id_order"),
+        data.get("id_piece", data.get("status"))
+    )
+
+
+def seen(key):
+    if key in handled_messages:
+        handled_messages.move_to_end(key)
+        return True
+    return False
+
+
+def remember(key):
+    handled_messages[key] = None
+    handled_messages.move_to_end(key)
+    if len(handled_messages) > DEDUP_CACHE_SIZE:
+        handled_messages.popitem(last=False)
+
+
+def count_duplicate():
+    dedup_stats["duplicates"] += 1
+
+
+def get_dedup_stats():
+    return dict(dedup_stats, cached=len(handled_messages))
@@ -0,0 +1,81 @@
+import asyncio
+import logging
+from os import environ
+from sql.database import SessionLocal # pylint: disable=import-outside-toplevel
+from sql import crud
+from routers import rabbitmq
+
+logger = logging.getLogger(__name__)
+
+# Outbox relay configuration
+OUTBOX_BATCH_SIZE = int(environ.get("OUTBOX_BATCH_SIZE", 500))
+OUTBOX_POLL_INTERVAL = float(environ.get("OUTBOX_POLL_INTERVAL", 1))
+OUTBOX_RETRY_DELAY = float(environ.get("OUTBOX_RETRY_DELAY", 5))
+# Seconds a relay owns the messages it claimed, after that another relay may publish them
+OUTBOX_LEASE = float(environ.get("OUTBOX_LEASE", 120))
+
+outbox_event = asyncio.Event()
+outbox_stats = {
+    "published": 0,
+    "failed": 0
+}
+
+
+def notify():
+    # Wake up the relay, new messages have been committed
+    outbox_event.set()
+
+
+async def relay_outbox():
+    while True:
+        try:
+            published = await relay_batch()
+        except Exception as exc:  # @ToDo: To broad exception
+            logger.error(f"Error relaying the outbox: {exc}")
+            await asyncio.sleep(OUTBOX_RETRY_DELAY)
+            continue
+        if published < OUTBOX_BATCH_SIZE:
+            # Outbox drained (or broker failing): wait for new messages
+            try:
+                await asyncio.wait_for(outbox_event.wait(), OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            outbox_event.clear()
+
+
+async def relay_batch():
+    db = SessionLocal()
+    try:
+        # Claimed messages are not published by the relays of other workers or replicas
+        messages = await crud.claim_outbox_messages(db, OUTBOX_BATCH_SIZE, OUTBOX_LEASE)
+        if not messages:
+            return 0
+        # Publish the whole batch and wait for all the broker confirmations together
+        results = await asyncio.gather(
+            *[rabbitmq.publish_message(message.exchange, message.body, message.routing_key, message.message_id)
+              for message in messages],
+            return_exceptions=True
+        )
+        published_ids = []
+        failed_ids = []
+        for message, result in zip(messages, results):
+            if isinstance(result, Exception):
+                outbox_stats["failed"] += 1
+                failed_ids.append(message.id)
+                logger.error(f"Could not publish {message.routing_key} message {message.id}: {result}")
+            else:
+                published_ids.append(message.id)
+        # Failed messages stay in the outbox and are retried in the next batch.
+        # A crash before the delete publishes them again with the same message_id
+        if failed_ids:
+            await crud.release_outbox_messages(db, failed_ids)
+        if published_ids:
+            await crud.delete_outbox_messages(db, published_ids)
+            outbox_stats["published"] += len(published_ids)
+        return len(published_ids)
+    finally:
+        await db.close()
+
+
+def get_outbox_stats():
+    return dict(outbox_stats)
@@ -1,250 +1,272 @@
-import aio_pika
+import asyncio
 import json
+import logging
 from sql.database import SessionLocal # pylint: disable=import-outside-toplevel
 from sql import crud
-from sql import models, schemas
+from sql import models
+from routers import broker
 from routers import security
+from routers import message_dedup
 from os import environ
 
+logger = logging.getLogger(__name__)
+
+# Consumer configuration
+CONSUMER_PREFETCH = int(environ.get("CONSUMER_PREFETCH", 64))
+CONSUMER_LANES = int(environ.get("CONSUMER_LANES", 8))
+# Saga handlers are idempotent (message_dedup and conditional transitions): a message that fails
+# is requeued (message.process(requeue=True)) and the lane waits before the next one, so a failing
+# message is retried instead of dropped but not in a busy loop
+CONSUMER_RETRY_DELAY = float(environ.get("CONSUMER_RETRY_DELAY", 1))
+
 async def subscribe_channel():
-    # Define your RabbitMQ server connection parameters directly as keyword arguments
-    connection = await aio_pika.connect_robust(
-        host=environ.get("RABBITMQ_IP"),
-        port=5672,
-        virtualhost='/',
-        login='user',
-        password='user'
-    )
-    # Create a channel
-    global channel
-    channel = await connection.channel()
+    # One connection per process, each consumer gets its own channel (see broker)
+    await broker.connect()
+    channel = await broker.open_channel()
     # Declare the exchange
     global exchange_events_name
     exchange_events_name = 'events'
-    global exchange_events
-    exchange_events = await channel.declare_exchange(name=exchange_events_name, type='topic', durable=True)
-    
+    await broker.declare_exchange(channel, exchange_events_name)
+
     global exchange_commands_name
     exchange_commands_name = 'commands'
-    global exchange_commands
-    exchange_commands = await channel.declare_exchange(name=exchange_commands_name, type='topic', durable=True)
-    
+    await broker.declare_exchange(channel, exchange_commands_name)
+
     global exchange_responses_name
     exchange_responses_name = 'responses'
-    global exchange_responses
-    exchange_responses = await channel.declare_exchange(name=exchange_responses_name, type='topic', durable=True)
-
+    await broker.declare_exchange(channel, exchange_responses_name)
+    await channel.close()
+
+
+async def consume(queue, on_message, lanes=CONSUMER_LANES):
+    # Messages of the same order always go to the same lane, so they are handled in order
+    lane_queues = [asyncio.Queue() for _ in range(lanes)]
+    workers = [asyncio.create_task(run_lane(lane_queue, on_message)) for lane_queue in lane_queues]
+    try:
+        async with queue.iterator() as queue_iter:
+            async for message in queue_iter:
+                await lane_queues[get_message_lane(message, lanes)].put(message)
+    finally:
+        for worker in workers:
+            worker.cancel()
+
+
+def get_message_lane(message, lanes):
+    try:
+        id_order = json.loads(message.body)['id_order']
+    except (ValueError, KeyError, TypeError):
+        return 0
+    return hash(id_order) % lanes
+
+
+async def run_lane(lane_queue, on_message):
+    while True:
+        message = await lane_queue.get()
+        try:
+            await on_message(message)
+        except Exception as exc:  # @ToDo: To broad exception
+            logger.error(f"Error handling message {message.routing_key}: {exc}")
+            await asyncio.sleep(CONSUMER_RETRY_DELAY)
+
+
+async def is_duplicate_message(db, key):
+    # Claims the message in the handler transaction, a redelivered message is acked without work
+    if message_dedup.seen(key) or not await crud.claim_message(db, key):
+        message_dedup.count_duplicate()
+        logger.info(f"Ignoring duplicated message {key}")
+        return True
+    return False
 
 
 async def on_piece_message(message):
-    async with message.process():
+    async with message.process(requeue=True):
         piece_recieve = json.loads(message.body)
         db = SessionLocal()
-        db_piece = await crud.change_piece_status(db, piece_recieve['id_piece'], models.Piece.STATUS_PRODUCED)
-        db_pieces = await crud.get_order_pieces(db, piece_recieve['id_order'])
-        order_finished = True
-        for piece in db_pieces:
-            if piece.status_piece == models.Piece.STATUS_QUEUED:
-                order_finished = False
-                break
-        if order_finished:
-            db_order = await crud.change_order_status(db, piece_recieve['id_order'], models.Order.STATUS_PRODUCED)
-            data = {
-                "id_order": piece_recieve['id_order']
-            }
-            message_body = json.dumps(data)
-            routing_key = "order.produced"
-            await publish_event(message_body, routing_key)
+        key = message_dedup.get_message_key(message, piece_recieve)
+        if await is_duplicate_message(db, key):
+            await db.close()
+            return
+        # The order moves to Produced (and its order.produced event is written to the outbox)
+        # in the same transaction as its last piece
+        await crud.change_piece_status(db, piece_recieve['id_piece'], models.Piece.STATUS_PRODUCED)
+        message_dedup.remember(key)
         await db.close()
 
 
 async def subscribe_pieces():
     # Create a queue
+    channel = await broker.consumer_channel(CONSUMER_PREFETCH)
     queue_name = "piece.produced"
-    queue = await channel.declare_queue(name=queue_name, exclusive=True)
+    queue = await channel.declare_queue(name=queue_name, durable=True)
     # Bind the queue to the exchange
     routing_key = "piece.produced"
     await queue.bind(exchange=exchange_events_name, routing_key=routing_key)
     # Set up a message consumer
-    async with queue.iterator() as queue_iter:
-        async for message in queue_iter:
-            await on_piece_message(message)
+    await consume(queue, on_piece_message)
 
 
 async def on_delivered_message(message):
-    async with message.process():
+    async with message.process(requeue=True):
         delivery = json.loads(message.body)
         db = SessionLocal()
+        key = message_dedup.get_message_key(message, delivery)
+        if await is_duplicate_message(db, key):
+            await db.close()
+            return
         db_order = await crud.change_order_status(db, delivery['id_order'], models.Order.STATUS_DELIVERED)
+        message_dedup.remember(key)
         await db.close()
 
 async def on_delivered_message_key_created(message):
     async with message.process():
-        await security.get_public_key()
+        security.rotate_public_key()
 
 
 async def subscribe_delivered():
     # Create a queue
+    channel = await broker.consumer_channel(CONSUMER_PREFETCH)
     queue_name = "order.delivered"
-    queue = await channel.declare_queue(name=queue_name, exclusive=True)
+    queue = await channel.declare_queue(name=queue_name, durable=True)
     # Bind the queue to the exchange
     routing_key = "order.delivered"
     await queue.bind(exchange=exchange_events_name, routing_key=routing_key)
     # Set up a message consumer
-    async with queue.iterator() as queue_iter:
-        async for message in queue_iter:
-            await on_delivered_message(message)
+    await consume(queue, on_delivered_message)
 
 async def subscribe_key_created():
     # Create a queue
-    queue_name = "client.key_created_order"
-    queue = await channel.declare_queue(name=queue_name, exclusive=True)
+    # Every worker of every replica needs its own copy of the event: server named queue
+    channel = await broker.consumer_channel(CONSUMER_PREFETCH)
+    queue = await channel.declare_queue(exclusive=True)
     # Bind the queue to the exchange
     routing_key = "client.key_created"
     await queue.bind(exchange=exchange_events_name, routing_key=routing_key)
     # Set up a message consumer
-    async with queue.iterator() as queue_iter:
-        async for message in queue_iter:
-            await on_delivered_message_key_created(message)
+    await consume(queue, on_delivered_message_key_created, lanes=1)
 
 
 async def on_delivering_message(message):
-    async with message.process():
+    async with message.process(requeue=True):
         delivery = json.loads(message.body)
         db = SessionLocal()
+        key = message_dedup.get_message_key(message, delivery)
+        if await is_duplicate_message(db, key):
+            await db.close()
+            return
         db_order = await crud.change_order_status(db, delivery['id_order'], models.Order.STATUS_DELIVERING)
+        message_dedup.remember(key)
         await db.close()
 
 
 async def subscribe_delivering():
     # Create a queue
+    channel = await broker.consumer_channel(CONSUMER_PREFETCH)
     queue_name = "order.delivering"
-    queue = await channel.declare_queue(name=queue_name, exclusive=True)
+    queue = await channel.declare_queue(name=queue_name, durable=True)
     # Bind the queue to the exchange
     routing_key = "order.delivering"
     await queue.bind(exchange=exchange_events_name, routing_key=routing_key)
     # Set up a message consumer
-    async with queue.iterator() as queue_iter:
-        async for message in queue_iter:
-            await on_delivering_message(message)
+    await consume(queue, on_delivering_message)
 
 
-async def publish_event(message_body, routing_key):
-    # Publish the message to the exchange
-    await exchange_events.publish(
-        aio_pika.Message(
-            body=message_body.encode(),
-            content_type="text/plain"
-        ),
-        routing_key=routing_key)
+async def publish_event(message_body, routing_key, message_id=None):
+    # Publish the message to the exchange through the publisher channel pool
+    await broker.publish(exchange_events_name, message_body, routing_key, message_id)
 
 
 async def on_delivery_checked_message(message):
-    async with message.process():
+    async with message.process(requeue=True):
         delivery = json.loads(message.body)
         db = SessionLocal()
-        db_saga = SessionLocal()
+        key = message_dedup.get_message_key(message, delivery)
+        if await is_duplicate_message(db, key):
+            await db.close()
+            return
         if delivery['status'] == True:
-            db_order = await crud.change_order_status(db, delivery['id_order'], models.Order.STATUS_PAYMENT_PENDING)
-            await crud.create_sagas_history(db_saga, delivery['id_order'], models.Order.STATUS_PAYMENT_PENDING)
-            data = {
-                "id_order": db_order.id_order,
-                "id_client": db_order.id_client,
-                "movement": -(db_order.number_of_pieces)
-            }
-            message_body = json.dumps(data)
-            routing_key = "payment.check"
-            await publish_command(message_body, routing_key)
+            # The payment.check command is written to the outbox with the status change
+            await crud.transition_order(db, delivery['id_order'], models.Order.STATUS_PAYMENT_PENDING)
         elif delivery['status'] == False:
-            db_order = await crud.change_order_status(db, delivery['id_order'], models.Order.STATUS_CANCELED)
-            await crud.create_sagas_history(db_saga, delivery['id_order'], models.Order.STATUS_CANCELED)
+            await crud.transition_order(db, delivery['id_order'], models.Order.STATUS_CANCELED)
+        message_dedup.remember(key)
         await db.close()
-        await db_saga.close()
 
 
 async def subscribe_delivery_checked():
     # Create a queue
+    channel = await broker.consumer_channel(CONSUMER_PREFETCH)
     queue_name = "delivery.checked"
-    queue = await channel.declare_queue(name=queue_name, exclusive=True)
+    queue = await channel.declare_queue(name=queue_name, durable=True)
     # Bind the queue to the exchange
     routing_key = "delivery.checked"
     await queue.bind(exchange=exchange_responses_name, routing_key=routing_key)
     # Set up a message consumer
-    async with queue.iterator() as queue_iter:
-        async for message in queue_iter:
-            await on_delivery_checked_message(message)
+    await consume(queue, on_delivery_checked_message)
 
 
 async def on_payment_checked_message(message):
-    async with message.process():
+    async with message.process(requeue=True):
         payment = json.loads(message.body)
         db = SessionLocal()
-        db_saga = SessionLocal()
+        key = message_dedup.get_message_key(message, payment)
+        if await is_duplicate_message(db, key):
+            await db.close()
+            return
         if payment['status'] == True:
-            db_order = await crud.change_order_status(db, payment['id_order'], models.Order.STATUS_QUEUED)
-            await crud.create_sagas_history(db_saga, payment['id_order'], models.Order.STATUS_QUEUED)
-            for i in range (0, db_order.number_of_pieces):
-                piece = schemas.PieceBase(
-                    status_piece=models.Piece.STATUS_QUEUED,
-                    id_order=db_order.id_order
-                    # no se si hay que meter manufacturing date
-                )
-                await crud.create_piece(db, piece)
+            # The pieces are created with the status change, a redelivered message does not create them again
+            await crud.transition_order(db, payment['id_order'], models.Order.STATUS_QUEUED)
         elif payment['status'] == False:
-            db_order = await crud.change_order_status(db, payment['id_order'], models.Order.STATUS_DELIVERY_CANCELING)
-            await crud.create_sagas_history(db_saga, payment['id_order'], models.Order.STATUS_DELIVERY_CANCELING)
-            data = {
-                "id_order": db_order.id_order
-            }
-            message_body = json.dumps(data)
-            routing_key = "delivery.cancel"
-            await publish_command(message_body, routing_key)
+            # The delivery.cancel command is written to the outbox with the status change
+            await crud.transition_order(db, payment['id_order'], models.Order.STATUS_DELIVERY_CANCELING)
+        message_dedup.remember(key)
         await db.close()
-        await db_saga.close()
 
 
 async def subscribe_payment_checked():
     # Create a queue
+    channel = await broker.consumer_channel(CONSUMER_PREFETCH)
     queue_name = "payment.checked"
-    queue = await channel.declare_queue(name=queue_name, exclusive=True)
+    queue = await channel.declare_queue(name=queue_name, durable=True)
     # Bind the queue to the exchange
     routing_key = "payment.checked"
     await queue.bind(exchange=exchange_responses_name, routing_key=routing_key)
     # Set up a message consumer
-    async with queue.iterator() as queue_iter:
-        async for message in queue_iter:
-            await on_payment_checked_message(message)
+    await consume(queue, on_payment_checked_message)
 
 
 async def on_delivery_canceled_message(message):
-    async with message.process():
+    async with message.process(requeue=True):
         delivery = json.loads(message.body)
         db = SessionLocal()
-        db_saga = SessionLocal()
-        db_order = await crud.change_order_status(db, delivery['id_order'], models.Order.STATUS_CANCELED)
-        await crud.create_sagas_history(db_saga, delivery['id_order'], models.Order.STATUS_CANCELED)
+        key = message_dedup.get_message_key(message, delivery)
+        if await is_duplicate_message(db, key):
+            await db.close()
+            return
+        await crud.transition_order(db, delivery['id_order'], models.Order.STATUS_CANCELED)
+        message_dedup.remember(key)
         await db.close()
-        await db_saga.close()
 
 
 async def subscribe_delivery_canceled():
     # Create a queue
+    channel = await broker.consumer_channel(CONSUMER_PREFETCH)
     queue_name = "delivery.canceled"
-    queue = await channel.declare_queue(name=queue_name, exclusive=True)
+    queue = await channel.declare_queue(name=queue_name, durable=True)
     # Bind the queue to the exchange
     routing_key = "delivery.canceled"
     await queue.bind(exchange=exchange_responses_name, routing_key=routing_key)
     # Set up a message consumer
-    async with queue.iterator() as queue_iter:
-        async for message in queue_iter:
-            await on_delivery_canceled_message(message)
-
-
-async def publish_command(message_body, routing_key):
-    # Publish the message to the exchange
-    await exchange_commands.publish(
-        aio_pika.Message(
-            body=message_body.encode(),
-            content_type="text/plain"
-        ),
-        routing_key=routing_key)
+    await consume(queue, on_delivery_canceled_message)
+
+
+async def publish_command(message_body, routing_key, message_id=None):
+    # Publish the message to the exchange through the publisher channel pool
+    await broker.publish(exchange_commands_name, message_body, routing_key, message_id)
+
+
+async def publish_message(exchange_name, message_body, routing_key, message_id=None):
+    # Publish the message to the exchange with the given name, waits for the broker confirmation
+    if exchange_name == exchange_commands_name:
+        await publish_command(message_body, routing_key, message_id)
+    else:
+        await publish_event(message_body, routing_key, message_id)
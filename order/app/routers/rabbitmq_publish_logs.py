@@ -1,32 +1,96 @@
 import aio_pika
+import asyncio
 import json
+import logging
+from routers import broker
 from sql.database import SessionLocal # pylint: disable=import-outside-toplevel
 from os import environ
 
+logger = logging.getLogger(__name__)
+
+# Log shipping configuration
+LOG_QUEUE_SIZE = int(environ.get("LOG_QUEUE_SIZE", 10000))
+LOG_BATCH_SIZE = int(environ.get("LOG_BATCH_SIZE", 100))
+LOG_FLUSH_INTERVAL = float(environ.get("LOG_FLUSH_INTERVAL", 0.5))
+# "drop": discard new log messages when the queue is full, "block": wait until there is room
+LOG_QUEUE_POLICY = environ.get("LOG_QUEUE_POLICY", "drop")
+
+log_queue = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
+log_stats = {
+    "queued": 0,
+    "sent": 0,
+    "dropped": 0,
+    "failed": 0
+}
+
+
 async def subscribe_channel():
-    # Define your RabbitMQ server connection parameters directly as keyword arguments
-    connection = await aio_pika.connect_robust(
-        host=environ.get("RABBITMQ_IP"),
-        port=5672,
-        virtualhost='/',
-        login='user',
-        password='user'
-    )
-    # Create a channel
+    # Dedicated channel on the shared broker connection, logs never wait behind saga traffic
     global channel
-    channel = await connection.channel()
+    channel = await broker.open_channel()
 
     global exchange_logs_name
     exchange_logs_name = 'logs'
     global exchange_logs
     exchange_logs = await channel.declare_exchange(name=exchange_logs_name, type='topic', durable=True)
 
+    global log_shipper_task
+    log_shipper_task = asyncio.create_task(ship_logs())
+
 
 async def publish_log(message_body, routing_key):
+    # Enqueue the message, the log shipper publishes it in the background
+    if LOG_QUEUE_POLICY == "block":
+        await log_queue.put((message_body, routing_key))
+    else:
+        try:
+            log_queue.put_nowait((message_body, routing_key))
+        except asyncio.QueueFull:
+            log_stats["dropped"] += 1
+            return
+    log_stats["queued"] += 1
+
+
+async def get_log_batch():
+    # Wait for the first message, then collect until the batch is full or the interval expires
+    batch = [await log_queue.get()]
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + LOG_FLUSH_INTERVAL
+    while len(batch) < LOG_BATCH_SIZE:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(log_queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+    return batch
+
+
+async def ship_logs():
+    while True:
+        batch = await get_log_batch()
+        results = await asyncio.gather(
+            *[send_log(message_body, routing_key) for message_body, routing_key in batch],
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                log_stats["failed"] += 1
+                logger.error(f"Could not publish log message: {result}")
+            else:
+                log_stats["sent"] += 1
+
+
+async def send_log(message_body, routing_key):
     # Publish the message to the exchange
     await exchange_logs.publish(
         aio_pika.Message(
             body=message_body.encode(),
             content_type="text/plain"
         ),
-        routing_key=routing_key)
\ No newline at end of file
+        routing_key=routing_key)
+
+
+def get_log_stats():
+    return dict(log_stats, pending=log_queue.qsize())
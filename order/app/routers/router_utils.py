@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 """Util/Helper functions for router definitions."""
+import base64
 import logging
 from fastapi import HTTPException
 
@@ -10,3 +11,13 @@ def raise_and_log_error(my_logger, status_code: int, message: str):
     """Raises HTTPException and logs an error."""
     my_logger.error(message)
     raise HTTPException(status_code, message)
+
+
+def encode_cursor(last_id: int):
+    """Opaque pagination token pointing after the given id."""
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    """Id encoded in a pagination token, raises ValueError if the token is not valid."""
+    return int(base64.urlsafe_b64decode(cursor.encode()).decode())
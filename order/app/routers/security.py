@@ -7,30 +7,108 @@ from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.asymmetric import rsa
 from routers.router_utils import raise_and_log_error
-from consulService.consul_router import get_consul_service
-import json
-import requests
+from consulService.BLConsul import get_consul_service_async, report_service_failure, report_service_latency
+import asyncio
+import httpx
+import hashlib
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from os import environ
 
 logger = logging.getLogger(__name__)
 
 public_key = ""
+public_key_object = None
+key_refresh_task = None
+# Incrementado con cada evento client.key_created
+key_generation = 0
+
+# Public key retrieval
+KEY_FETCH_TIMEOUT = float(environ.get("KEY_FETCH_TIMEOUT", 5))
+http_client = None
+
+# Verified tokens cache: token digest -> (payload, expiration timestamp)
+TOKEN_CACHE_SIZE = int(environ.get("TOKEN_CACHE_SIZE", 4096))
+token_cache = OrderedDict()
+token_cache_stats = {
+    "hits": 0,
+    "misses": 0
+}
 
 async def isTherePublicKey():
-    if public_key == "":
-        return await get_public_key()
+    if public_key_object is None:
+        # No se espera a la descarga, se lanza en segundo plano
+        refresh_public_key()
+        return False
     else:
         return True
 
+def get_http_client():
+    # Cliente HTTP compartido, mantiene las conexiones abiertas entre peticiones
+    global http_client
+    if http_client is None:
+        http_client = httpx.AsyncClient(
+            timeout=KEY_FETCH_TIMEOUT,
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=5)
+        )
+    return http_client
+
+async def close_http_client():
+    global http_client
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+
+def refresh_public_key():
+    # Solo hay una descarga de la clave en curso, las peticiones concurrentes comparten la tarea
+    global key_refresh_task
+    if key_refresh_task is None or key_refresh_task.done():
+        key_refresh_task = asyncio.create_task(fetch_public_key())
+    return key_refresh_task
+
+def rotate_public_key():
+    # Una descarga en curso pudo empezar antes de la rotación y devolver la clave antigua:
+    # la nueva descarga empieza cuando termine, y las peticiones sin clave comparten esta tarea
+    global key_generation, key_refresh_task
+    key_generation += 1
+    key_refresh_task = asyncio.create_task(fetch_rotated_public_key(key_refresh_task, key_generation))
+    return key_refresh_task
+
+async def fetch_rotated_public_key(previous_task, generation):
+    if previous_task is not None and not previous_task.done():
+        await asyncio.wait({previous_task})
+    if generation != key_generation:
+        # Ha llegado otra rotación mientras tanto, su descarga (que espera a esta) obtiene la clave
+        return public_key_object is not None
+    return await fetch_public_key()
+
 async def get_public_key():
-    global public_key
+    return await asyncio.shield(refresh_public_key())
+
+async def fetch_public_key():
+    global public_key, public_key_object
     try:
-        ret = get_consul_service("_client._tcp")
-        response = requests.get(f"http://{ret['Address']}:{ret['Port']}/client/key")
+        ret = await get_consul_service_async("_client._tcp")
+        start = time.monotonic()
+        try:
+            response = await get_http_client().get(f"http://{ret['Address']}:{ret['Port']}/client/key")
+        except httpx.TransportError:
+            report_service_failure("_client._tcp", ret['Address'], ret['Port'])
+            raise
+        report_service_latency(ret['Address'], ret['Port'], time.monotonic() - start)
         if response.status_code == 200:
-            public_key = response.text.strip('"').replace("\\n", "\n")
+            new_public_key = response.text.strip('"').replace("\\n", "\n")
+            if new_public_key != public_key:
+                key_object = serialization.load_pem_public_key(new_public_key.encode())
+                # Tokens verified with the old key are no longer trusted
+                token_cache.clear()
+                public_key_object = key_object
+                public_key = new_public_key
             return True
         return False
-    except requests.RequestException as e:
+    except Exception as exc:  # @ToDo: To broad exception
+        logger.error(f"Could not get the public key: {exc}")
         return False
 
 def generar_claves():
@@ -64,25 +142,51 @@ def generar_claves():
         public_key_file.write(public_key_pem)
 
 def decode_token(token:str):
+    # Los tokens ya verificados se sirven desde la caché hasta su fecha de expiración
+    digest = hashlib.sha256(token.encode()).digest()
+    cached = token_cache.get(digest)
+    if cached is not None:
+        payload, exp_timestamp = cached
+        if exp_timestamp > time.time():
+            token_cache.move_to_end(digest)
+            token_cache_stats["hits"] += 1
+            return dict(payload)
+        del token_cache[digest]
+    token_cache_stats["misses"] += 1
     try:
-        payload = json.loads(json.dumps(jwt.decode(token, public_key, ['RS256'])))
-        return payload
+        payload = jwt.decode(token, public_key_object, ['RS256'])
     except Exception as exc:  # @ToDo: To broad exception
         raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"Error decoding the token: {exc}")
+    try:
+        exp_timestamp = get_expiration_timestamp(payload.get("fecha_expiracion"))
+    except (TypeError, ValueError):
+        # Sin fecha de expiración válida no se guarda en caché
+        return payload
+    token_cache[digest] = (payload, exp_timestamp)
+    if len(token_cache) > TOKEN_CACHE_SIZE:
+        token_cache.popitem(last=False)
+    return dict(payload)
 
-def validar_fecha_expiracion(payload:dict):
-    # Obtiene la fecha de expiración del token
-    exp_timestamp_str = payload.get("fecha_expiracion")
+@lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def get_expiration_timestamp(exp_timestamp_str:str):
+    # Convierte la fecha de expiración (UTC) del token en tiempo Unix
     exp_timestamp_datetime = datetime.fromisoformat(exp_timestamp_str)
     exp_timestamp = exp_timestamp_datetime.timestamp()
-    # Convierte el tiempo Unix en una fecha y hora
     exp_datetime = datetime.utcfromtimestamp(exp_timestamp)
+    return (exp_datetime - datetime(1970, 1, 1)).total_seconds()
+
+def validar_fecha_expiracion(payload:dict):
+    # Obtiene la fecha de expiración del token
+    exp_timestamp = get_expiration_timestamp(payload.get("fecha_expiracion"))
     # Comprueba si el token ha expirado
-    if exp_datetime <= datetime.utcnow():
+    if exp_timestamp <= time.time():
         return True
     else:
         return False
 
+def get_token_cache_stats():
+    return dict(token_cache_stats, size=len(token_cache))
+
 def validar_es_admin(payload:dict):
     # Obtiene la fecha de expiración del token
     role = payload.get("role")
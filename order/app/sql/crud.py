@@ -1,13 +1,16 @@
 # -*- coding: utf-8 -*-
 """Functions that interact with the database."""
 import logging
-from datetime import datetime
+import uuid
+from datetime import datetime, timedelta
+from sqlalchemy import delete, insert, or_, text, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
+from sqlalchemy.orm import selectinload
 from sqlalchemy.sql import func
-from sql.database import SessionLocal # pylint: disable=import-outside-toplevel
-from routers.rabbitmq import publish_event, publish_command
-from . import models
+from routers import outbox
+from . import models, schemas, order_cache
 import json
 
 
@@ -16,14 +19,14 @@ import json
 async def get_list(db: AsyncSession, model):
     """Retrieve a list of elements from database"""
     result = await db.execute(select(model))
-    item_list = result.unique().scalars().all()
+    item_list = result.scalars().all()
     return item_list
 
 
 async def get_list_statement_result(db: AsyncSession, stmt):
     """Execute given statement and return list of items."""
     result = await db.execute(stmt)
-    item_list = result.unique().scalars().all()
+    item_list = result.scalars().all()
     return item_list
 
 
@@ -52,17 +55,76 @@ async def delete_element_by_id(db: AsyncSession, model, element_id):
     return element
 
 
+# Rows per multi-row insert (orders, sagas, outbox and pieces). SQLite limits the bound parameters
+# of a single statement (999 before 3.32), keep them under it: rows have up to 5 columns.
+INSERT_CHUNK = 150
+
+# Tables that can be exported
+EXPORT_TABLES = {
+    "orders": models.Order,
+    "pieces": models.Piece,
+    "sagas": models.SagasHistory
+}
+
+
+async def stream_table_rows(db: AsyncSession, model, chunk_size):
+    """Yield the rows of a table as lists of dicts, read through a server side cursor."""
+    # Core select: plain rows, without the ORM loading the relationships
+    stmt = select(model.__table__).order_by(*model.__table__.primary_key.columns)
+    result = await db.stream(stmt.execution_options(yield_per=chunk_size))
+    async for partition in result.partitions(chunk_size):
+        yield [dict(row._mapping) for row in partition]
+
+
+async def check_database(db: AsyncSession):
+    """Cheapest round trip to the database, raises if it is not reachable."""
+    await db.execute(text("SELECT 1"))
+
+
 # Order functions ##################################################################################
-async def get_orders_list(db: AsyncSession):
-    """Load all the orders from the database."""
+def select_orders(include_pieces=False):
+    """Order statement, loading the pieces with a second SELECT ... IN query if requested."""
     stmt = select(models.Order)
+    if include_pieces:
+        stmt = stmt.options(selectinload(models.Order.pieces))
+    return stmt
+
+
+async def get_orders_list(db: AsyncSession, limit, after_id=None, status=None, date_from=None, date_to=None,
+                          include_pieces=False):
+    """Load a page of orders from the database, returns the orders and whether there are more."""
+    stmt = select_orders(include_pieces)
+    return await get_orders_page(db, stmt, limit, after_id, status, date_from, date_to)
+
+
+async def get_orders_page(db: AsyncSession, stmt, limit, after_id=None, status=None, date_from=None, date_to=None):
+    """Apply keyset pagination (orders after after_id) and filters to an order statement."""
+    if after_id is not None:
+        stmt = stmt.where(models.Order.id_order > after_id)
+    if status is not None:
+        stmt = stmt.where(models.Order.status_order == status)
+    if date_from is not None:
+        stmt = stmt.where(models.Order.creation_date >= date_from)
+    if date_to is not None:
+        stmt = stmt.where(models.Order.creation_date < date_to)
+    # One extra row tells if there is a next page
+    stmt = stmt.order_by(models.Order.id_order).limit(limit + 1)
     orders = await get_list_statement_result(db, stmt)
-    return orders
+    return orders[:limit], len(orders) > limit
 
 
-async def get_order(db: AsyncSession, order_id):
+async def get_order(db: AsyncSession, order_id, include_pieces=False):
     """Load an order from the database."""
-    return await get_element_by_id(db, models.Order, order_id)
+    if not include_pieces:
+        return await get_element_by_id(db, models.Order, order_id)
+    stmt = select_orders(include_pieces).where(models.Order.id_order == order_id)
+    return await get_element_statement_result(db, stmt)
+
+
+async def get_orders_by_ids(db: AsyncSession, order_ids, include_pieces=False):
+    """Load the orders with the given ids with a single query."""
+    stmt = select_orders(include_pieces).where(models.Order.id_order.in_(order_ids))
+    return await get_list_statement_result(db, stmt)
 
 
 async def get_piece(db: AsyncSession, piece_id):
@@ -70,11 +132,11 @@ async def get_piece(db: AsyncSession, piece_id):
     return await get_element_by_id(db, models.Piece, piece_id)
 
 
-async def get_clients_orders(db: AsyncSession, client_id):
-    """Load all the orders from the database."""
-    stmt = select(models.Order).where(models.Order.id_client == client_id)
-    orders = await get_list_statement_result(db, stmt)
-    return orders
+async def get_clients_orders(db: AsyncSession, client_id, limit, after_id=None, status=None, date_from=None, date_to=None,
+                             include_pieces=False):
+    """Load a page of the orders of a client, returns the orders and whether there are more."""
+    stmt = select_orders(include_pieces).where(models.Order.id_client == client_id)
+    return await get_orders_page(db, stmt, limit, after_id, status, date_from, date_to)
 
 
 async def get_sagas_history_by_order_id(db: AsyncSession, id_order):
@@ -84,8 +146,12 @@ async def get_sagas_history_by_order_id(db: AsyncSession, id_order):
     return sagas
 
 
-async def create_order(db: AsyncSession, order):
-    """Persist a new order into the database."""
+async def create_order(db: AsyncSession, order, idempotency_key=None, idempotency_ttl=None, request_hash=None):
+    """Persist a new order into the database.
+
+    With an idempotency key, the response is stored in the same transaction to replay retries.
+    Raises IntegrityError (after rolling back) if a concurrent request stored the same key first.
+    """
     movement = - float(order.number_of_pieces)
     if movement >= 0:
         raise Exception("You can't order that amount of pieces.")
@@ -96,27 +162,173 @@ async def create_order(db: AsyncSession, order):
         status_order=models.Order.STATUS_DELIVERY_PENDING
     )
     db.add(db_order)
-    await db.commit()
-    await db.refresh(db_order)
-    db_saga = SessionLocal()
-    await create_sagas_history(db_saga, db_order.id_order, db_order.status_order)
-    await db_saga.close()
+    await db.flush()
+    db.add(models.SagasHistory(id_order=db_order.id_order, status=db_order.status_order))
     data = {
         "id_order": db_order.id_order,
         "id_client": db_order.id_client
     }
     message_body = json.dumps(data)
     routing_key = "delivery.check"
-    await publish_command(message_body, routing_key)
+    add_outbox_message(db, models.Outbox.EXCHANGE_COMMANDS, routing_key, message_body)
+    if idempotency_key is not None:
+        # An expired record is only purged by the housekeeping, replace it
+        await db.execute(delete(models.IdempotencyRecord).where(
+            models.IdempotencyRecord.key == idempotency_key,
+            models.IdempotencyRecord.expires_at <= datetime.utcnow()
+        ))
+        db.add(models.IdempotencyRecord(
+            key=idempotency_key,
+            status_code=201,
+            response_body=schemas.Order.from_orm(db_order).json(),
+            expires_at=datetime.utcnow() + timedelta(seconds=idempotency_ttl),
+            request_hash=request_hash
+        ))
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise
+    outbox.notify()
     return db_order
 
 
+async def create_orders_bulk(db: AsyncSession, orders):
+    """Persist several new orders, their sagas history and delivery.check commands in one transaction.
+
+    Returns a (db_order, error) tuple per requested order, invalid orders are not created.
+    """
+    results = []
+    db_orders = []
+    for order in orders:
+        if order.number_of_pieces is None or order.number_of_pieces <= 0:
+            results.append((None, "You can't order that amount of pieces."))
+            continue
+        db_order = models.Order(
+            number_of_pieces=order.number_of_pieces,
+            description=order.description,
+            id_client=order.id_client,
+            status_order=models.Order.STATUS_DELIVERY_PENDING,
+            pieces_produced=0
+        )
+        db_orders.append(db_order)
+        results.append((db_order, None))
+    if not db_orders:
+        return results
+    # Multi-row inserts: one statement per chunk instead of one per order
+    rows = [
+        {
+            "number_of_pieces": db_order.number_of_pieces,
+            "description": db_order.description,
+            "id_client": db_order.id_client,
+            "status_order": db_order.status_order,
+            "pieces_produced": 0
+        }
+        for db_order in db_orders
+    ]
+    for i in range(0, len(rows), INSERT_CHUNK):
+        chunk = rows[i:i + INSERT_CHUNK]
+        chunk_ids = await insert_returning_ids(db, models.Order, models.Order.id_order, chunk)
+        for db_order, id_order in zip(db_orders[i:i + INSERT_CHUNK], chunk_ids):
+            db_order.id_order = id_order
+    sagas = [
+        {"id_order": db_order.id_order, "status": db_order.status_order}
+        for db_order in db_orders
+    ]
+    messages = [
+        {
+            "message_id": str(uuid.uuid4()),
+            "exchange": models.Outbox.EXCHANGE_COMMANDS,
+            "routing_key": "delivery.check",
+            "body": json.dumps({"id_order": db_order.id_order, "id_client": db_order.id_client})
+        }
+        for db_order in db_orders
+    ]
+    for i in range(0, len(db_orders), INSERT_CHUNK):
+        await db.execute(insert(models.SagasHistory).values(sagas[i:i + INSERT_CHUNK]))
+        await db.execute(insert(models.Outbox).values(messages[i:i + INSERT_CHUNK]))
+    await db.commit()
+    outbox.notify()
+    return results
+
+
+async def insert_returning_ids(db: AsyncSession, model, id_column, rows):
+    """Insert the rows with a single statement, returns their primary keys in the same order."""
+    if db.bind.dialect.full_returning:
+        # The ids are drawn from the sequence in VALUES order, but RETURNING rows come in no
+        # guaranteed order: sort them to pair them with the rows
+        result = await db.execute(insert(model).values(rows).returning(id_column))
+        return sorted(result.scalars().all())
+    # SQLite (no RETURNING in SQLAlchemy 1.4): the transaction holds the write lock since the
+    # INSERT, so the rows just inserted are the newest ones, numbered in insertion order
+    await db.execute(insert(model).values(rows))
+    result = await db.execute(select(id_column).order_by(id_column.desc()).limit(len(rows)))
+    return list(reversed(result.scalars().all()))
+
+
+async def update_order_status(db: AsyncSession, id, status, *conditions):
+    """Change order status without committing, None if the transition is not allowed."""
+    stmt = update(models.Order).where(models.Order.id_order == id, *conditions)
+    previous_status = models.Order.TRANSITIONS.get(status)
+    if previous_status is not None:
+        stmt = stmt.where(models.Order.status_order.in_(previous_status))
+    stmt = stmt.values(status_order=status).execution_options(synchronize_session=False)
+    result = await db.execute(stmt)
+    if result.rowcount == 0:
+        return None
+    db_order = await db.get(models.Order, id, populate_existing=True)
+    await add_transition_messages(db, db_order)
+    return db_order
+
+
+async def add_transition_messages(db: AsyncSession, db_order):
+    """Write to the outbox the saga messages that follow the new order status."""
+    if db_order.status_order == models.Order.STATUS_PAYMENT_PENDING:
+        data = {
+            "id_order": db_order.id_order,
+            "id_client": db_order.id_client,
+            "movement": -(db_order.number_of_pieces)
+        }
+        add_outbox_message(db, models.Outbox.EXCHANGE_COMMANDS, "payment.check", json.dumps(data))
+    elif db_order.status_order == models.Order.STATUS_DELIVERY_CANCELING:
+        data = {
+            "id_order": db_order.id_order
+        }
+        add_outbox_message(db, models.Outbox.EXCHANGE_COMMANDS, "delivery.cancel", json.dumps(data))
+    elif db_order.status_order == models.Order.STATUS_QUEUED:
+        await add_pieces(db, db_order.id_order, db_order.number_of_pieces)
+    elif db_order.status_order == models.Order.STATUS_PRODUCED:
+        data = {
+            "id_order": db_order.id_order
+        }
+        add_outbox_message(db, models.Outbox.EXCHANGE_EVENTS, "order.produced", json.dumps(data))
+
+
 async def change_order_status(db: AsyncSession, id, status):
-    """Change order status in the database."""
-    db_order = await get_order(db, id)
-    db_order.status_order = status
+    """Change order status in the database, None if the transition is not allowed."""
+    db_order = await update_order_status(db, id, status)
+    await db.commit()
+    if db_order is not None:
+        order_cache.invalidate(id)
+    outbox.notify()
+    return db_order
+
+
+async def transition_order(db: AsyncSession, id, status):
+    """Change order status and append its sagas history in a single transaction.
+
+    The saga messages that follow the transition (and the pieces of a queued order)
+    are written in the same transaction. Returns None if the transition is not
+    allowed (e.g. redelivered saga message).
+    """
+    db_order = await update_order_status(db, id, status)
+    if db_order is None:
+        await db.rollback()
+        return None
+    db.add(models.SagasHistory(id_order=id, status=status))
     await db.commit()
-    await db.refresh(db_order)
+    order_cache.invalidate(id)
+    outbox.notify()
     return db_order
 
 
@@ -137,33 +349,63 @@ async def get_sagas_history(db: AsyncSession, id_order):
     return await get_sagas_history_by_order_id(db, id_order)
 
 
-async def create_piece(db: AsyncSession, piece):
-    """Persist a new piece into the database."""
-    db_piece = models.Piece(
-        status_piece=piece.status_piece,
-        id_order=piece.id_order
-    )
-    db.add(db_piece)
-    await db.commit()
-    await db.refresh(db_piece)
-    data = {
-        "id_order": db_piece.id_order,
-        "id_piece": db_piece.id_piece
-    }
-    # Crear evento con nueva order, indicando ID de cliente y cantidad de piezas.
-    message_body = json.dumps(data)
-    routing_key = "piece.needed"
-    await publish_event(message_body, routing_key)
-    return db_piece
+async def add_pieces(db: AsyncSession, id_order, number_of_pieces):
+    """Insert all the pieces of an order and their piece.needed events without committing."""
+    rows = [
+        {"status_piece": models.Piece.STATUS_QUEUED, "id_order": id_order}
+        for _ in range(number_of_pieces)
+    ]
+    for i in range(0, len(rows), INSERT_CHUNK):
+        await db.execute(insert(models.Piece).values(rows[i:i + INSERT_CHUNK]))
+    stmt = select(models.Piece.id_piece).where(models.Piece.id_order == id_order)
+    result = await db.execute(stmt)
+    piece_ids = result.scalars().all()
+    messages = [
+        {
+            "message_id": str(uuid.uuid4()),
+            "exchange": models.Outbox.EXCHANGE_EVENTS,
+            "routing_key": "piece.needed",
+            "body": json.dumps({"id_order": id_order, "id_piece": piece_id})
+        }
+        for piece_id in piece_ids
+    ]
+    for i in range(0, len(messages), INSERT_CHUNK):
+        await db.execute(insert(models.Outbox).values(messages[i:i + INSERT_CHUNK]))
+    return piece_ids
 
 
 async def change_piece_status(db: AsyncSession, piece_id, status):
-    """Change piece status in the database."""
-    db_piece = await get_piece(db, piece_id)
-    db_piece.status_piece = status
-    db_piece.manufacturing_date = func.now()
+    """Change a queued piece status in the database, None if it was already changed.
+
+    A produced piece is counted in its order, which moves to Produced with its last piece.
+    """
+    stmt = update(models.Piece).where(
+        models.Piece.id_piece == piece_id,
+        models.Piece.status_piece == models.Piece.STATUS_QUEUED
+    ).values(
+        status_piece=status,
+        manufacturing_date=func.now()
+    ).execution_options(synchronize_session=False)
+    result = await db.execute(stmt)
+    if result.rowcount == 0:
+        await db.rollback()
+        return None
+    db_piece = await db.get(models.Piece, piece_id, populate_existing=True)
+    if status == models.Piece.STATUS_PRODUCED:
+        # Count the piece and finish the order when it was the last one, in the same transaction
+        stmt = update(models.Order).where(
+            models.Order.id_order == db_piece.id_order
+        ).values(
+            pieces_produced=models.Order.pieces_produced + 1
+        ).execution_options(synchronize_session=False)
+        await db.execute(stmt)
+        await update_order_status(
+            db, db_piece.id_order, models.Order.STATUS_PRODUCED,
+            models.Order.pieces_produced >= models.Order.number_of_pieces
+        )
     await db.commit()
-    await db.refresh(db_piece)
+    order_cache.invalidate(db_piece.id_order)
+    outbox.notify()
     return db_piece
 
 
@@ -172,3 +414,87 @@ async def get_order_pieces(db: AsyncSession, order_id):
     stmt = select(models.Piece).where(models.Piece.id_order == order_id)
     pieces = await get_list_statement_result(db, stmt)
     return pieces
+
+
+# Outbox functions #################################################################################
+def add_outbox_message(db: AsyncSession, exchange, routing_key, message_body):
+    """Add a message to the outbox, it is published once the transaction commits."""
+    db_message = models.Outbox(
+        exchange=exchange,
+        routing_key=routing_key,
+        body=message_body
+    )
+    db.add(db_message)
+    return db_message
+
+
+async def claim_outbox_messages(db: AsyncSession, limit, lease):
+    """Claim the oldest messages nobody is publishing, for lease seconds, and load them.
+
+    Relays of other workers or replicas sharing the database skip claimed messages. On
+    PostgreSQL rows locked by a concurrent claim are skipped, SQLite serializes the UPDATE.
+    """
+    now = datetime.utcnow()
+    claim = uuid.uuid4().hex
+    available = or_(models.Outbox.claimed_until.is_(None), models.Outbox.claimed_until < now)
+    oldest = select(models.Outbox.id).where(available).order_by(models.Outbox.id).limit(limit) \
+        .with_for_update(skip_locked=True)
+    stmt = update(models.Outbox).where(models.Outbox.id.in_(oldest), available) \
+        .values(claimed_by=claim, claimed_until=now + timedelta(seconds=lease)) \
+        .execution_options(synchronize_session=False)
+    await db.execute(stmt)
+    await db.commit()
+    stmt = select(models.Outbox).where(models.Outbox.claimed_by == claim).order_by(models.Outbox.id)
+    return await get_list_statement_result(db, stmt)
+
+
+async def release_outbox_messages(db: AsyncSession, message_ids):
+    """Give up the claim of messages that could not be published, the next claim retries them."""
+    stmt = update(models.Outbox).where(models.Outbox.id.in_(message_ids)) \
+        .values(claimed_by=None, claimed_until=None) \
+        .execution_options(synchronize_session=False)
+    await db.execute(stmt)
+    await db.commit()
+
+
+async def delete_outbox_messages(db: AsyncSession, message_ids):
+    """Remove published messages from the outbox."""
+    stmt = delete(models.Outbox).where(models.Outbox.id.in_(message_ids))
+    await db.execute(stmt)
+    await db.commit()
+
+
+# Processed messages functions #####################################################################
+async def claim_message(db: AsyncSession, key):
+    """Record a message as processed in the current transaction, False if it already was."""
+    db.add(models.ProcessedMessage(key=key))
+    try:
+        await db.flush()
+    except IntegrityError:
+        await db.rollback()
+        return False
+    return True
+
+
+async def delete_processed_messages(db: AsyncSession, retention_seconds):
+    """Forget the processed messages older than the retention period."""
+    limit_date = datetime.utcnow() - timedelta(seconds=retention_seconds)
+    stmt = delete(models.ProcessedMessage).where(models.ProcessedMessage.creation_date < limit_date)
+    await db.execute(stmt)
+    await db.commit()
+
+
+# Idempotency functions ############################################################################
+async def get_idempotency_record(db: AsyncSession, key):
+    """Load the stored response of an idempotency key, None if there is none or it expired."""
+    record = await get_element_by_id(db, models.IdempotencyRecord, key)
+    if record is None or record.expires_at <= datetime.utcnow():
+        return None
+    return record
+
+
+async def delete_expired_idempotency_records(db: AsyncSession):
+    """Forget the expired idempotency records."""
+    stmt = delete(models.IdempotencyRecord).where(models.IdempotencyRecord.expires_at <= datetime.utcnow())
+    await db.execute(stmt)
+    await db.commit()
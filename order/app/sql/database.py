@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 """Database session configuration."""
 import os
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
@@ -10,17 +12,59 @@ SQLALCHEMY_DATABASE_URL = os.getenv(
     "sqlite+aiosqlite:///./orders.db"
 )
 
-engine = create_async_engine(
-    SQLALCHEMY_DATABASE_URL,
-    connect_args={"check_same_thread": False},
-    echo=False
-)
+# SQLite (sqlite+aiosqlite://) settings, applied to every new connection
+SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', "WAL")
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', "NORMAL")
+SQLITE_BUSY_TIMEOUT = int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000))  # milliseconds
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 268435456))  # bytes
+
+# Connection pool settings for server databases (e.g. postgresql+asyncpg://)
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 20))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))  # seconds
+DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', 30))  # seconds
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL lets readers and one writer work concurrently, NORMAL only fsyncs on checkpoints."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.close()
+
+
+def create_engine(database_url):
+    """Create the async engine with the settings of its database backend."""
+    if make_url(database_url).get_backend_name() == "sqlite":
+        sqlite_engine = create_async_engine(
+            database_url,
+            connect_args={"check_same_thread": False},
+            echo=False
+        )
+        event.listen(sqlite_engine.sync_engine, "connect", set_sqlite_pragmas)
+        return sqlite_engine
+    return create_async_engine(
+        database_url,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_pre_ping=True,
+        echo=False
+    )
+
+
+engine = create_engine(SQLALCHEMY_DATABASE_URL)
 
 SessionLocal = sessionmaker(
     autocommit=False,
     autoflush=False,
     bind=engine,
     class_=AsyncSession,
+    # Objects stay usable after commit without lazy loading them again (not allowed in asyncio)
+    expire_on_commit=False,
     future=True
 )
 
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""Periodic removal of expired rows."""
+import asyncio
+import logging
+from os import environ
+from sql.database import SessionLocal
+from sql import crud
+
+logger = logging.getLogger(__name__)
+
+HOUSEKEEPING_INTERVAL = int(environ.get("HOUSEKEEPING_INTERVAL", 3600))  # seconds
+# Processed message keys are kept in the database for this long (seconds)
+DEDUP_RETENTION = int(environ.get("DEDUP_RETENTION", 7 * 24 * 3600))
+
+
+async def purge_expired_records():
+    """Periodically delete old processed messages and expired idempotency records."""
+    while True:
+        await asyncio.sleep(HOUSEKEEPING_INTERVAL)
+        db = SessionLocal()
+        try:
+            await crud.delete_processed_messages(db, DEDUP_RETENTION)
+            await crud.delete_expired_idempotency_records(db)
+        except Exception as exc:  # @ToDo: To broad exception
+            logger.error(f"Error purging expired records: {exc}")
+        finally:
+            await db.close()
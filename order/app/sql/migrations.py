@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""Versioned schema migrations for databases created by previous versions."""
+import logging
+from sqlalchemy import inspect, select, func, text
+from . import models
+
+logger = logging.getLogger(__name__)
+
+
+def add_pieces_produced(conn):
+    """Add the produced pieces counter to the orders and count the pieces produced so far."""
+    columns = [column["name"] for column in inspect(conn).get_columns("orders")]
+    if "pieces_produced" in columns:
+        return
+    conn.execute(text("ALTER TABLE orders ADD COLUMN pieces_produced INTEGER NOT NULL DEFAULT 0"))
+    # Without the (id_order, status_piece) index every order scans the whole pieces table
+    for index in models.Piece.__table__.indexes:
+        index.create(conn, checkfirst=True)
+    conn.execute(text(
+        "UPDATE orders SET pieces_produced = ("
+        "SELECT COUNT(*) FROM pieces "
+        "WHERE pieces.id_order = orders.id_order AND pieces.status_piece = :status)"
+    ), {"status": models.Piece.STATUS_PRODUCED})
+
+
+def create_indexes(conn):
+    """Create the secondary indexes of the tables."""
+    for model in (models.Order, models.Piece, models.SagasHistory):
+        for index in model.__table__.indexes:
+            index.create(conn, checkfirst=True)
+
+
+# Ordered migrations: (version, description, function). Never change an applied one, add a new version.
+MIGRATIONS = [
+    (1, "Add orders.pieces_produced", add_pieces_produced),
+    (2, "Secondary indexes on orders, pieces and sagas", create_indexes),
+]
+
+
+def run_migrations(conn):
+    """Apply the migrations newer than the database schema version (run with conn.run_sync)."""
+    table = models.SchemaVersion.__table__
+    current_version = conn.execute(select(func.max(table.c.version))).scalar() or 0
+    for version, description, migration in MIGRATIONS:
+        if version <= current_version:
+            continue
+        logger.info(f"Applying schema migration {version}: {description}")
+        migration(conn)
+        conn.execute(table.insert().values(version=version, description=description))
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 """Database models definitions. Table representations as class."""
-from sqlalchemy import Column, DateTime, Integer, String, TEXT, ForeignKey, Float
+import uuid
+from sqlalchemy import Column, DateTime, Integer, String, TEXT, ForeignKey, Float, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from .database import Base
@@ -46,19 +47,41 @@ class Order(BaseModel):
     STATUS_DELIVERING = "Delivering"
     STATUS_DELIVERED = "Delivered"
 
+    # Statuses an order must be in to move to the given status. Saga messages can be
+    # redelivered, a transition from any other status is a duplicate and is ignored.
+    TRANSITIONS = {
+        STATUS_PAYMENT_PENDING: (STATUS_DELIVERY_PENDING,),
+        STATUS_DELIVERY_CANCELING: (STATUS_PAYMENT_PENDING,),
+        STATUS_CANCELED: (STATUS_DELIVERY_PENDING, STATUS_DELIVERY_CANCELING),
+        STATUS_QUEUED: (STATUS_PAYMENT_PENDING,),
+        STATUS_PRODUCED: (STATUS_QUEUED,),
+        STATUS_DELIVERING: (STATUS_PRODUCED,),
+        STATUS_DELIVERED: (STATUS_PRODUCED, STATUS_DELIVERING),
+    }
+
     __tablename__ = "orders"
+    __table_args__ = (
+        # Client order lists and status filters, paginated by id_order
+        Index("ix_orders_id_client_id_order", "id_client", "id_order"),
+        Index("ix_orders_status_order_id_order", "status_order", "id_order"),
+    )
     id_order = Column(Integer, primary_key=True)
     number_of_pieces = Column(Integer, nullable=False)
     description = Column(TEXT, nullable=False, default="No description")
     status_order = Column(String(256), nullable=False)
     id_client = Column(Integer, nullable=False)
+    pieces_produced = Column(Integer, nullable=False, default=0, server_default="0")
 
-    pieces = relationship("Piece", back_populates="order", lazy="joined")
+    # Pieces are only loaded on demand (crud include_pieces uses selectinload), never implicitly
+    pieces = relationship("Piece", back_populates="order", lazy="raise")
 
 
 class SagasHistory(BaseModel):
     """Sagas history database table representation."""
     __tablename__ = "sagas"
+    __table_args__ = (
+        Index("ix_sagas_id_order_id", "id_order", "id"),
+    )
     id = Column(Integer, primary_key=True)
     id_order = Column(Integer, nullable=False)
     status = Column(String(256), nullable=False)
@@ -70,6 +93,9 @@ class Piece(BaseModel):
     STATUS_PRODUCED = "Produced"
 
     __tablename__ = "pieces"
+    __table_args__ = (
+        Index("ix_pieces_id_order_status_piece", "id_order", "status_piece"),
+    )
     id_piece = Column(Integer, primary_key=True)
     manufacturing_date = Column(DateTime(timezone=True), server_default=None)
     status_piece = Column(String(256))
@@ -78,4 +104,48 @@ class Piece(BaseModel):
         ForeignKey('orders.id_order', ondelete='cascade'),
         nullable=True)
 
-    order = relationship('Order', back_populates='pieces', lazy="joined")
+    order = relationship('Order', back_populates='pieces', lazy="raise")
+
+
+class Outbox(BaseModel):
+    """Messages pending to be published to RabbitMQ, written with the state change."""
+    EXCHANGE_EVENTS = "events"
+    EXCHANGE_COMMANDS = "commands"
+
+    __tablename__ = "outbox"
+    id = Column(Integer, primary_key=True)
+    # Sent as the AMQP message_id, the same on every republication so consumers can drop duplicates
+    message_id = Column(String(64), nullable=False, default=lambda: str(uuid.uuid4()))
+    exchange = Column(String(256), nullable=False)
+    routing_key = Column(String(256), nullable=False)
+    body = Column(TEXT, nullable=False)
+    # Lease of the relay publishing the message, other relays skip it until it expires
+    claimed_by = Column(String(32), nullable=True)
+    claimed_until = Column(DateTime, nullable=True)
+
+
+class SchemaVersion(BaseModel):
+    """Applied schema migrations database table representation."""
+    __tablename__ = "schema_version"
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    description = Column(String(256), nullable=False)
+
+
+class ProcessedMessage(BaseModel):
+    """Saga messages already handled, to ignore redeliveries."""
+    __tablename__ = "processed_messages"
+    key = Column(String(256), primary_key=True)
+
+
+class IdempotencyRecord(BaseModel):
+    """Stored responses of requests sent with an Idempotency-Key header."""
+    __tablename__ = "idempotency_records"
+    __table_args__ = (
+        Index("ix_idempotency_records_expires_at", "expires_at"),
+    )
+    key = Column(String(512), primary_key=True)
+    status_code = Column(Integer, nullable=False)
+    response_body = Column(TEXT, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+    # SHA-256 of the request, a key reused with a different request is rejected
+    request_hash = Column(String(64), nullable=True)
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""In-process LRU cache of serialized single order responses."""
+import time
+from collections import OrderedDict
+from os import environ
+
+ORDER_CACHE_SIZE = int(environ.get("ORDER_CACHE_SIZE", 10000))
+# Other replicas do not invalidate this cache, bound how stale an entry can get
+ORDER_CACHE_TTL = float(environ.get("ORDER_CACHE_TTL", 5))
+
+# (id_order, include_pieces) -> (expiration time, serialized order)
+order_cache = OrderedDict()
+order_cache_stats = {
+    "hits": 0,
+    "misses": 0,
+    "invalidations": 0
+}
+
+
+def get(id_order, include_pieces=False):
+    """Serialized order if cached, None otherwise."""
+    key = (id_order, include_pieces)
+    cached = order_cache.get(key)
+    if cached is not None and cached[0] > time.monotonic():
+        order_cache.move_to_end(key)
+        order_cache_stats["hits"] += 1
+        return cached[1]
+    if cached is not None:
+        del order_cache[key]
+    order_cache_stats["misses"] += 1
+    return None
+
+
+def put(id_order, include_pieces, order):
+    """Cache a serialized order, evicting the least recently used one if full."""
+    order_cache[(id_order, include_pieces)] = (time.monotonic() + ORDER_CACHE_TTL, order)
+    order_cache.move_to_end((id_order, include_pieces))
+    if len(order_cache) > ORDER_CACHE_SIZE:
+        order_cache.popitem(last=False)
+
+
+def invalidate(id_order):
+    """Forget an order that has changed."""
+    order_cache_stats["invalidations"] += 1
+    order_cache.pop((id_order, False), None)
+    order_cache.pop((id_order, True), None)
+
+
+def get_stats():
+    return dict(order_cache_stats, size=len(order_cache))
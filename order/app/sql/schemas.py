@@ -52,6 +52,28 @@ class OrderPost(OrderBase):
     """Schema definition to create a new order."""
 
 
+class OrderBulkPost(BaseModel):
+    """Schema definition to create several orders at once."""
+    orders: List[OrderPost] = Field(
+        description="Orders to create."
+    )
+
+
+class OrderBulkResult(BaseModel):
+    """Result of each order of a bulk creation."""
+    index: int = Field(
+        description="Position of the order in the request.",
+        example=0
+    )
+    order: Optional[Order] = Field(
+        description="Created order, null if it could not be created."
+    )
+    detail: Optional[str] = Field(
+        description="Why the order could not be created.",
+        example="You can't order that amount of pieces."
+    )
+
+
 class PieceBase(BaseModel):
     """Piece base schema definition."""
     
@@ -80,6 +102,27 @@ class Piece(PieceBase):
         orm_mode = True
 
 
+class OrderWithPieces(Order):
+    """Order schema definition including its pieces."""
+    pieces: List[Piece] = Field(
+        description="Pieces of the order.",
+        default=[]
+    )
+
+
+class OrderBatchPost(BaseModel):
+    """Schema definition to retrieve several orders at once."""
+    ids: List[int] = Field(
+        description="Identifiers of the orders.",
+        example=[1, 2, 3]
+    )
+    include: Optional[str] = Field(
+        description="'pieces' to include the pieces of the orders.",
+        default=None,
+        example="pieces"
+    )
+
+
 class SagasHistoryBase(BaseModel):
     """Sagas history base schema definition."""
     id: int = Field()
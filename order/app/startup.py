@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""Startup steps of the service: timeouts, retries, timings and readiness state."""
+import asyncio
+import logging
+import time
+from os import environ
+
+logger = logging.getLogger(__name__)
+
+STARTUP_STEP_TIMEOUT = float(environ.get("STARTUP_STEP_TIMEOUT", 30))
+STARTUP_RETRY_DELAY = float(environ.get("STARTUP_RETRY_DELAY", 5))
+
+STATUS_STARTING = "starting"
+STATUS_READY = "ready"
+
+startup_state = {
+    "status": STATUS_STARTING,
+    "started_at": None,
+    "seconds": None,
+    "steps": {}
+}
+# Keep a reference to the background steps so they are not garbage collected
+background_tasks = set()
+
+
+def begin():
+    startup_state["started_at"] = time.monotonic()
+
+
+def set_ready():
+    startup_state["status"] = STATUS_READY
+    startup_state["seconds"] = round(time.monotonic() - startup_state["started_at"], 3)
+    logger.info(f"Service ready in {startup_state['seconds']}s")
+
+
+def is_ready():
+    return startup_state["status"] == STATUS_READY
+
+
+async def run_step(name, step, timeout=STARTUP_STEP_TIMEOUT):
+    """Run a step once, recording its outcome and duration. Returns whether it succeeded.
+
+    With timeout None the step runs until it ends.
+    """
+    step_state = startup_state["steps"].setdefault(name, {"attempts": 0})
+    step_state["attempts"] += 1
+    step_state["status"] = "running"
+    start = time.monotonic()
+    try:
+        await asyncio.wait_for(step(), timeout)
+    except asyncio.TimeoutError:
+        step_state["status"] = "timeout"
+        step_state["error"] = f"Timed out after {timeout}s"
+    except Exception as exc:  # @ToDo: To broad exception
+        step_state["status"] = "failed"
+        step_state["error"] = repr(exc)
+    else:
+        step_state["status"] = "done"
+        step_state.pop("error", None)
+    step_state["seconds"] = round(time.monotonic() - start, 3)
+    if step_state["status"] != "done":
+        logger.error(f"Startup step {name} {step_state['status']}: {step_state['error']}")
+        return False
+    logger.info(f"Startup step {name} done in {step_state['seconds']}s")
+    return True
+
+
+async def run_until_done(name, step, timeout=STARTUP_STEP_TIMEOUT):
+    """Run a step until it succeeds, waiting STARTUP_RETRY_DELAY between attempts."""
+    while not await run_step(name, step, timeout):
+        await asyncio.sleep(STARTUP_RETRY_DELAY)
+
+
+def start_task(coroutine):
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+def defer(name, step, timeout=STARTUP_STEP_TIMEOUT):
+    """Non critical step: run it in the background, the service does not wait for it."""
+    startup_state["steps"][name] = {"attempts": 0, "status": "deferred"}
+    return start_task(run_until_done(name, step, timeout))
+
+
+def get_startup_state():
+    return {
+        "status": startup_state["status"],
+        "seconds": startup_state["seconds"],
+        "steps": {name: dict(step_state) for name, step_state in startup_state["steps"].items()}
+    }
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""Compare creating orders one by one (POST /order) with a bulk creation (POST /order/bulk).
+
+    python benchmarks/bench_bulk_orders.py --orders 300 --rounds 5
+
+Runs the crud functions behind both endpoints on a temporary SQLite database and reports
+orders per second and the SQL statements sent per bulk creation.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+DATABASE_FILE = os.path.join(tempfile.mkdtemp(), "bench.db")
+os.environ["SQLALCHEMY_DATABASE_URL"] = f"sqlite+aiosqlite:///{DATABASE_FILE}"
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from sqlalchemy import event  # noqa: E402
+from sql import crud, database, models, schemas  # noqa: E402
+
+statements = []
+
+
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    statements.append(statement.split(None, 3)[:3])
+
+
+def new_orders(count):
+    return [schemas.OrderPost(number_of_pieces=5, description="bench", id_client=1) for _ in range(count)]
+
+
+async def time_single(count):
+    db = database.SessionLocal()
+    start = time.perf_counter()
+    for order in new_orders(count):
+        await crud.create_order(db, order)
+    elapsed = time.perf_counter() - start
+    await db.close()
+    return elapsed
+
+
+async def time_bulk(count):
+    db = database.SessionLocal()
+    orders = new_orders(count)
+    start = time.perf_counter()
+    results = await crud.create_orders_bulk(db, orders)
+    elapsed = time.perf_counter() - start
+    await db.close()
+    assert len({db_order.id_order for db_order, _ in results}) == count
+    return elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=300)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    async with database.engine.begin() as conn:
+        await conn.run_sync(models.Base.metadata.create_all)
+    event.listen(database.engine.sync_engine, "before_cursor_execute", count_statement)
+
+    single = min([await time_single(args.orders) for _ in range(args.rounds)])
+    statements.clear()
+    bulk = min([await time_bulk(args.orders) for _ in range(args.rounds)])
+    inserts = [statement for statement in statements if statement[0] == "INSERT"]
+    print(f"{args.orders} orders, best of {args.rounds} rounds")
+    print(f"single: {single:.3f}s  {args.orders / single:,.0f} orders/s")
+    print(f"bulk:   {bulk:.3f}s  {args.orders / bulk:,.0f} orders/s  "
+          f"({len(statements) // args.rounds} statements, {len(inserts) // args.rounds} INSERT per bulk)")
+    await database.engine.dispose()
+    os.remove(DATABASE_FILE)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
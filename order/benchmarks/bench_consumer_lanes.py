@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""Throughput of the saga consumer runtime (rabbitmq.consume) against the number of lanes.
+
+    python benchmarks/bench_consumer_lanes.py --messages 2000 --orders 200 --handler-ms 5
+
+Messages come from an in-process stand-in for a RabbitMQ queue that honours the prefetch: it
+delivers at most CONSUMER_PREFETCH unacknowledged messages. The handler awaits --handler-ms,
+standing for the database round trips of a saga handler, and checks that the messages of each
+order are handled in the order they were delivered.
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import bench_setup  # noqa: F401
+from routers import rabbitmq
+
+
+class StandInMessage:
+    def __init__(self, queue, body):
+        self.queue = queue
+        self.body = body
+        self.routing_key = "bench"
+
+    def process(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        # Ack: frees a prefetch slot
+        self.queue.unacked.release()
+        self.queue.acked += 1
+
+
+class StandInQueue:
+    def __init__(self, bodies, prefetch):
+        self.bodies = bodies
+        self.unacked = asyncio.Semaphore(prefetch)
+        self.acked = 0
+
+    def iterator(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def __aiter__(self):
+        for body in self.bodies:
+            await self.unacked.acquire()
+            yield StandInMessage(self, body)
+        # Keep consuming until every delivered message is acked, then the consumer stops
+        while self.acked < len(self.bodies):
+            await asyncio.sleep(0.001)
+
+
+async def run(messages, orders, lanes, handler_seconds):
+    bodies = [json.dumps({"id_order": i % orders, "sequence": i // orders}).encode() for i in range(messages)]
+    last_sequence = {}
+
+    async def on_message(message):
+        async with message.process():
+            data = json.loads(message.body)
+            assert last_sequence.get(data["id_order"], -1) < data["sequence"], "order handled out of sequence"
+            last_sequence[data["id_order"]] = data["sequence"]
+            await asyncio.sleep(handler_seconds)
+
+    queue = StandInQueue(bodies, rabbitmq.CONSUMER_PREFETCH)
+    start = time.perf_counter()
+    await rabbitmq.consume(queue, on_message, lanes=lanes)
+    elapsed = time.perf_counter() - start
+    assert queue.acked == messages
+    return elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--orders", type=int, default=200)
+    parser.add_argument("--handler-ms", type=float, default=5)
+    parser.add_argument("--lanes", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    args = parser.parse_args()
+
+    print(f"{args.messages} messages of {args.orders} orders, prefetch {rabbitmq.CONSUMER_PREFETCH}, "
+          f"handler {args.handler_ms}ms")
+    print(f"{'lanes':>6} {'seconds':>9} {'msg/s':>8}")
+    for lanes in args.lanes:
+        elapsed = await run(args.messages, args.orders, lanes, args.handler_ms / 1000)
+        print(f"{lanes:>6} {elapsed:>8.2f}s {args.messages / elapsed:>8,.0f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
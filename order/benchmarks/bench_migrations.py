@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""Time the order, piece and saga queries on a large database without and with the new indexes.
+
+    python benchmarks/bench_migrations.py --orders 200000 --pieces 5 --sagas 5 --queries 50
+
+Creates a database with the schema of the baseline version of the service (no pieces_produced
+column and no secondary indexes) and times run_migrations on it. Then it times
+crud.get_clients_orders, crud.get_order_pieces and crud.get_sagas_history_by_order_id with the
+secondary indexes dropped (the baseline tables) and once they are created again.
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from sqlalchemy import create_engine, text  # noqa: E402
+from sqlalchemy.ext.asyncio import AsyncSession  # noqa: E402
+from sql import crud, database, models, migrations  # noqa: E402
+
+INDEXED_MODELS = (models.Order, models.Piece, models.SagasHistory)
+CLIENTS = 10000  # 20 orders per client with the default --orders
+
+BASELINE_SCHEMA = [
+    "CREATE TABLE orders (creation_date DATETIME DEFAULT (CURRENT_TIMESTAMP), id_order INTEGER PRIMARY KEY, "
+    "number_of_pieces INTEGER NOT NULL, description TEXT NOT NULL, status_order VARCHAR(256) NOT NULL, "
+    "id_client INTEGER NOT NULL)",
+    "CREATE TABLE sagas (creation_date DATETIME DEFAULT (CURRENT_TIMESTAMP), id INTEGER PRIMARY KEY, "
+    "id_order INTEGER NOT NULL, status VARCHAR(256) NOT NULL)",
+    "CREATE TABLE pieces (creation_date DATETIME DEFAULT (CURRENT_TIMESTAMP), id_piece INTEGER PRIMARY KEY, "
+    "manufacturing_date DATETIME, status_piece VARCHAR(256), "
+    "id_order INTEGER REFERENCES orders (id_order) ON DELETE cascade)",
+]
+
+def create_baseline_database(path, orders, pieces, sagas):
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.begin() as conn:
+        for statement in BASELINE_SCHEMA:
+            conn.execute(text(statement))
+        conn.execute(
+            text("INSERT INTO orders (id_order, number_of_pieces, description, status_order, id_client) "
+                 "VALUES (:id, :pieces, 'bench', 'Queued', :client)"),
+            [{"id": i, "pieces": pieces, "client": i % CLIENTS} for i in range(1, orders + 1)]
+        )
+        conn.execute(
+            text("INSERT INTO pieces (status_piece, id_order) VALUES (:status, :id_order)"),
+            [{"status": "Produced" if p % 2 else "Queued", "id_order": i}
+             for i in range(1, orders + 1) for p in range(pieces)]
+        )
+        conn.execute(
+            text("INSERT INTO sagas (id_order, status) VALUES (:id_order, 'Queued')"),
+            [{"id_order": i} for i in range(1, orders + 1) for _ in range(sagas)]
+        )
+    engine.dispose()
+
+
+def time_migrations(path):
+    """Upgrade the database as the service does at startup: create_all, then run_migrations."""
+    engine = create_engine(f"sqlite:///{path}")
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        models.Base.metadata.create_all(conn)
+        migrations.run_migrations(conn)
+    elapsed = time.perf_counter() - start
+    with engine.connect() as conn:
+        wrong = conn.execute(text(
+            "SELECT COUNT(*) FROM orders WHERE pieces_produced != "
+            "(SELECT COUNT(*) FROM pieces WHERE pieces.id_order = orders.id_order "
+            "AND pieces.status_piece = 'Produced')"
+        )).scalar()
+    engine.dispose()
+    assert wrong == 0, f"{wrong} orders with a wrong pieces_produced"
+    return elapsed
+
+
+def set_indexes(path, indexed):
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.begin() as conn:
+        if indexed:
+            migrations.create_indexes(conn)
+        else:
+            for model in INDEXED_MODELS:
+                for index in model.__table__.indexes:
+                    index.drop(conn, checkfirst=True)
+        conn.execute(text("ANALYZE"))
+    engine.dispose()
+
+
+async def time_queries(path, orders, queries):
+    """Average milliseconds per call of each query, on random clients and orders."""
+    engine = database.create_engine(f"sqlite+aiosqlite:///{path}")
+    randomizer = random.Random(0)
+    queries_by_name = {
+        "get_clients_orders": lambda db: crud.get_clients_orders(db, randomizer.randrange(CLIENTS), 50),
+        "get_order_pieces": lambda db: crud.get_order_pieces(db, randomizer.randint(1, orders)),
+        "get_sagas_history_by_order_id":
+            lambda db: crud.get_sagas_history_by_order_id(db, randomizer.randint(1, orders)),
+    }
+    timings = {}
+    async with AsyncSession(engine, expire_on_commit=False) as db:
+        for name, query in queries_by_name.items():
+            await query(db)  # warm up the page cache
+            start = time.perf_counter()
+            for _ in range(queries):
+                await query(db)
+            timings[name] = (time.perf_counter() - start) / queries * 1000
+    await engine.dispose()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=200000)
+    parser.add_argument("--pieces", type=int, default=5, help="pieces per order")
+    parser.add_argument("--sagas", type=int, default=5, help="saga history rows per order")
+    parser.add_argument("--queries", type=int, default=50, help="calls of each query")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(workdir, "baseline.db")
+        create_baseline_database(path, args.orders, args.pieces, args.sagas)
+        print(f"{args.orders} orders, {args.orders * args.pieces} pieces, {args.orders * args.sagas} sagas")
+        print(f"run_migrations: {time_migrations(path):.2f}s")
+        set_indexes(path, indexed=False)
+        without_indexes = asyncio.run(time_queries(path, args.orders, args.queries))
+        set_indexes(path, indexed=True)
+        with_indexes = asyncio.run(time_queries(path, args.orders, args.queries))
+        print(f"{'query':<30} {'no indexes':>11} {'indexes':>9} {'speedup':>8}")
+        for name, before in without_indexes.items():
+            after = with_indexes[name]
+            print(f"{name:<30} {before:>9.2f}ms {after:>7.3f}ms {before / after:>7.0f}x")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
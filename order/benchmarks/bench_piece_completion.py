@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""Time producing every piece of an order, as on_piece_message does for each piece.produced.
+
+    python benchmarks/bench_piece_completion.py --sizes 10 1000 10000 --legacy-max 1000
+
+"counter" is crud.change_piece_status, which counts the piece and finishes the order with a
+conditional UPDATE. "legacy" adds what the handler did before: load every piece of the order and
+scan them for queued ones, O(N) per piece and O(N^2) per order (only run up to --legacy-max).
+"""
+import argparse
+import asyncio
+import time
+
+import bench_setup
+from sql import crud, database, models
+
+
+async def produce_order(number_of_pieces, legacy):
+    db = database.SessionLocal()
+    id_order = await bench_setup.create_order(db, number_of_pieces)
+    piece_ids = await crud.add_pieces(db, id_order, number_of_pieces)
+    await db.commit()
+    start = time.perf_counter()
+    for piece_id in piece_ids:
+        await crud.change_piece_status(db, piece_id, models.Piece.STATUS_PRODUCED)
+        if legacy:
+            db_pieces = await crud.get_order_pieces(db, id_order)
+            any(piece.status_piece == models.Piece.STATUS_QUEUED for piece in db_pieces)
+    elapsed = time.perf_counter() - start
+    db_order = await crud.get_order(db, id_order)
+    assert db_order.status_order == models.Order.STATUS_PRODUCED
+    await db.close()
+    return elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 10000])
+    parser.add_argument("--legacy-max", type=int, default=1000, help="largest order timed with the legacy scan")
+    args = parser.parse_args()
+
+    await bench_setup.create_tables()
+    print(f"{'pieces':>8} {'counter':>10} {'per piece':>10} {'legacy':>10} {'per piece':>10}")
+    for size in args.sizes:
+        counter = await produce_order(size, legacy=False)
+        line = f"{size:>8} {counter:>9.3f}s {counter / size * 1000:>8.3f}ms"
+        if size <= args.legacy_max:
+            legacy = await produce_order(size, legacy=True)
+            line += f" {legacy:>9.3f}s {legacy / size * 1000:>8.3f}ms"
+        print(line)
+    await bench_setup.drop_database()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""Time creating the pieces of a paid order against the order size.
+
+    python benchmarks/bench_piece_fanout.py --sizes 10 100 1000 5000
+
+"bulk" is crud.add_pieces, as the order moves to Queued: multi-row inserts of the pieces and their
+piece.needed outbox rows, committed in one transaction. "legacy" is the previous loop: one INSERT, commit and refresh per piece (the
+per piece broker publish it also did is not included).
+"""
+import argparse
+import asyncio
+import time
+
+import bench_setup
+from sql import crud, database, models
+
+
+async def create_pieces_bulk(db, id_order, number_of_pieces):
+    await crud.add_pieces(db, id_order, number_of_pieces)
+    await db.commit()
+
+
+async def create_pieces_legacy(db, id_order, number_of_pieces):
+    for _ in range(number_of_pieces):
+        db_piece = models.Piece(status_piece=models.Piece.STATUS_QUEUED, id_order=id_order)
+        db.add(db_piece)
+        await db.commit()
+        await db.refresh(db_piece)
+
+
+async def time_fanout(number_of_pieces, create):
+    db = database.SessionLocal()
+    id_order = await bench_setup.create_order(db, number_of_pieces)
+    start = time.perf_counter()
+    await create(db, id_order, number_of_pieces)
+    elapsed = time.perf_counter() - start
+    assert len(await crud.get_order_pieces(db, id_order)) == number_of_pieces
+    await db.close()
+    return elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    args = parser.parse_args()
+
+    await bench_setup.create_tables()
+    print(f"{'pieces':>8} {'bulk':>10} {'legacy':>10} {'speedup':>8}")
+    for size in args.sizes:
+        bulk = await time_fanout(size, create_pieces_bulk)
+        legacy = await time_fanout(size, create_pieces_legacy)
+        print(f"{size:>8} {bulk:>9.3f}s {legacy:>9.3f}s {legacy / bulk:>7.1f}x")
+    await bench_setup.drop_database()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
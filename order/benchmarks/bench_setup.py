@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""Shared setup of the benchmarks: import path of the service and a temporary SQLite database.
+
+Import it before any module of the service, the database URL is read when sql.database loads.
+"""
+import os
+import sys
+import tempfile
+
+DATABASE_FILE = os.path.join(tempfile.mkdtemp(), "bench.db")
+os.environ["SQLALCHEMY_DATABASE_URL"] = f"sqlite+aiosqlite:///{DATABASE_FILE}"
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from sql import database, models  # noqa: E402
+
+
+async def create_tables():
+    async with database.engine.begin() as conn:
+        await conn.run_sync(models.Base.metadata.create_all)
+
+
+async def create_order(db, number_of_pieces, status=models.Order.STATUS_QUEUED):
+    db_order = models.Order(
+        number_of_pieces=number_of_pieces,
+        description="bench",
+        id_client=1,
+        status_order=status,
+        pieces_produced=0
+    )
+    db.add(db_order)
+    await db.commit()
+    return db_order.id_order
+
+
+async def drop_database():
+    await database.engine.dispose()
+    os.remove(DATABASE_FILE)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""Per-request authentication cost: security.decode_token + validar_fecha_expiracion.
+
+    python benchmarks/bench_token_cache.py --requests 2000
+
+"legacy" is the previous code: RS256 verification and a JSON round trip of the payload on every
+request, then parsing the ISO expiration date. "cold" sends a new token on every request (every
+lookup misses the cache), "warm" sends the same token again and again.
+"""
+import argparse
+import json
+import time
+from datetime import datetime, timedelta
+
+import bench_setup  # noqa: F401
+import jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from routers import security
+
+
+def legacy_auth(token):
+    payload = json.loads(json.dumps(jwt.decode(token, security.public_key, ['RS256'])))
+    exp_datetime = datetime.utcfromtimestamp(datetime.fromisoformat(payload["fecha_expiracion"]).timestamp())
+    return exp_datetime <= datetime.utcnow()
+
+
+def cached_auth(token):
+    payload = security.decode_token(token)
+    return security.validar_fecha_expiracion(payload)
+
+
+def time_per_request(auth, tokens):
+    start = time.perf_counter()
+    for token in tokens:
+        assert not auth(token)
+    return (time.perf_counter() - start) / len(tokens) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    security.public_key_object = private_key.public_key()
+    security.public_key = security.public_key_object.public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    ).decode()
+    expiration = datetime.utcnow() + timedelta(hours=1)
+    tokens = [
+        jwt.encode({"id_client": i, "role": 0, "fecha_expiracion": expiration.isoformat()}, private_key, "RS256")
+        for i in range(args.requests)
+    ]
+
+    legacy = time_per_request(legacy_auth, tokens)
+    security.token_cache.clear()
+    cold = time_per_request(cached_auth, tokens)
+    warm = time_per_request(cached_auth, [tokens[0]] * args.requests)
+    print(f"{args.requests} requests, RS256 2048 bits")
+    print(f"legacy: {legacy:8.1f} us/request")
+    print(f"cold:   {cold:8.1f} us/request")
+    print(f"warm:   {warm:8.1f} us/request  ({legacy / warm:,.0f}x faster than legacy)")
+    print(f"cache:  {security.get_token_cache_stats()}")
+
+
+if __name__ == "__main__":
+    main()
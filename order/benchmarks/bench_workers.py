@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""Throughput of the service under gunicorn with 1, 2, 4 and 8 UvicornWorker processes.
+
+    python benchmarks/bench_workers.py --workers 1 2 4 8 --seconds 10 --concurrency 64
+
+Starts the service as the Dockerfile does, with its default timeouts, on a temporary SQLite database with --orders orders,
+and sends authenticated GET /order?limit=50 requests (token decoding, a database page and its
+serialization) from --concurrency concurrent clients. RabbitMQ and Consul are not needed: their
+startup steps keep retrying in the background. Run it on a host with at least 8 cores, the load
+generator shares them with the workers.
+"""
+import argparse
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import bench_setup
+import httpx
+import jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from sql import database, models
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(BENCHMARKS_DIR, "..", "app")
+PORT = 18099
+# Same defaults as the Dockerfile
+WORKER_TIMEOUT = os.getenv("WORKER_TIMEOUT", "60")
+WORKER_GRACEFUL_TIMEOUT = os.getenv("WORKER_GRACEFUL_TIMEOUT", "30")
+URL = f"http://127.0.0.1:{PORT}/order"
+
+
+async def seed_orders(count):
+    await bench_setup.create_tables()
+    db = database.SessionLocal()
+    db.add_all([
+        models.Order(number_of_pieces=5, description="bench", id_client=1,
+                     status_order=models.Order.STATUS_QUEUED, pieces_produced=0)
+        for _ in range(count)
+    ])
+    await db.commit()
+    await db.close()
+    await database.engine.dispose()
+
+
+def start_server(workers, environment):
+    return subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "--workers", str(workers),
+         "--worker-class", "uvicorn.workers.UvicornWorker", "--timeout", WORKER_TIMEOUT,
+         "--graceful-timeout", WORKER_GRACEFUL_TIMEOUT, "--bind", f"127.0.0.1:{PORT}",
+         "--chdir", APP_DIR, "--pythonpath", BENCHMARKS_DIR, "--log-level", "warning",
+         "bench_workers_app:app"],
+        env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True
+    )
+
+
+async def wait_until_serving(client, token, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get(URL, params={"limit": 1}, headers={"token": token})).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.5)
+    raise RuntimeError("The service did not start")
+
+
+async def load(client, token, seconds, concurrency):
+    deadline = time.monotonic() + seconds
+    counts = {"ok": 0, "errors": 0}
+
+    async def run_client():
+        while time.monotonic() < deadline:
+            try:
+                response = await client.get(URL, params={"limit": 50}, headers={"token": token})
+            except httpx.TransportError:
+                counts["errors"] += 1
+                continue
+            counts["ok" if response.status_code == 200 else "errors"] += 1
+
+    await asyncio.gather(*[run_client() for _ in range(concurrency)])
+    return counts
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--orders", type=int, default=1000)
+    args = parser.parse_args()
+
+    await seed_orders(args.orders)
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    public_key_file = os.path.join(tempfile.mkdtemp(), "public_key.pem")
+    with open(public_key_file, "wb") as key_file:
+        key_file.write(private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        ))
+    expiration = datetime.utcnow() + timedelta(hours=1)
+    token = jwt.encode({"id_client": 1, "role": 1, "fecha_expiracion": expiration.isoformat()}, private_key, "RS256")
+
+    print(f"{os.cpu_count()} CPUs, {args.concurrency} concurrent clients, {args.seconds}s per run")
+    print(f"{'workers':>8} {'req/s':>8} {'errors':>7}")
+    limits = httpx.Limits(max_connections=args.concurrency)
+    for workers in args.workers:
+        environment = dict(os.environ, BENCH_PUBLIC_KEY_FILE=public_key_file, LOCK_DIR=tempfile.mkdtemp(),
+                           RABBITMQ_IP="127.0.0.1")
+        server = start_server(workers, environment)
+        try:
+            async with httpx.AsyncClient(timeout=30, limits=limits) as client:
+                await wait_until_serving(client, token)
+                await load(client, token, 1, args.concurrency)  # warm up every worker
+                counts = await load(client, token, args.seconds, args.concurrency)
+            print(f"{workers:>8} {counts['ok'] / args.seconds:>8,.0f} {counts['errors']:>7}")
+        finally:
+            os.killpg(server.pid, signal.SIGTERM)
+            server.wait()
+    os.remove(bench_setup.DATABASE_FILE)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
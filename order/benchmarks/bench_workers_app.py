@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+"""The service app for bench_workers.py: every worker trusts the benchmark's public key."""
+import os
+
+import main
+from cryptography.hazmat.primitives import serialization
+from routers import security
+
+with open(os.environ["BENCH_PUBLIC_KEY_FILE"], "rb") as public_key_file:
+    security.public_key = public_key_file.read().decode()
+security.public_key_object = serialization.load_pem_public_key(security.public_key.encode())
+
+app = main.app
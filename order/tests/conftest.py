@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+"""The service modules are imported as the Dockerfile runs them, from the app directory."""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))